@@ -0,0 +1,133 @@
+# cost model of the pipeline, used by schedule.py --plan (and for packing languages with --pack)
+# it's calibrated from the throughput measured by earlier runs, stored in their stage records (output_dir/manifest/*.json),
+# the defaults are rough guesses for LUMI used when there is nothing to calibrate from
+
+import glob
+import json
+from statistics import median
+
+
+DEFAULT_SHARD_MB_PER_SECOND = 15.0  # per shard job, of uncompressed input
+DEFAULT_TOKENIZE_MB_PER_SECOND = 1.0  # per tokenization rank
+DEFAULT_TOKENIZER_SECONDS = 2 * 3600
+DEFAULT_SUBWORDS_PER_BYTE = 0.25
+DEFAULT_TOKENIZE_RSS_BASE_MB = 2048.0  # peak memory of a tokenization rank: the interpreter, torch and the tokenizer,
+DEFAULT_TOKENIZE_RSS_PER_MB = 3.0  # plus this per MB of its text shard
+MIN_RSS_FIT_MB = 64.0  # smaller shards only measure the base memory, their ratio of memory to size is meaningless
+
+# allocated resources of the sbatch scripts
+SHARD_CORES = 7
+TOKENIZER_CORES = 7
+TOKENIZE_CORES_PER_RANK = 1
+CORES_PER_NODE = 128
+MEMORY_PER_NODE_MB = 224 * 1024
+GPUS_PER_NODE = 8
+JOB_STARTUP_SECONDS = 120  # loading the modules and the virtual environment, not counting the time in the queue
+
+
+def read_throughput_records(pattern):
+    records = []
+    for path in glob.glob(pattern):
+        try:
+            with open(path, "r") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if "throughput" in record:
+            records.append(record["throughput"])
+    return records
+
+
+def rate(records, numerator, denominator, default):
+    # total work over total time of all records
+    total_numerator = sum(record[numerator] for record in records)
+    total_denominator = sum(record[denominator] for record in records)
+    if len(records) == 0 or total_denominator <= 0:
+        return default
+    return total_numerator / total_denominator
+
+
+def fit_tokenize_memory(records):
+    # returns (base MB, MB per shard MB) of the peak memory of a tokenization rank: the slope is fitted (least squares)
+    # on the shards of at least MIN_RSS_FIT_MB, the base is the intercept or, with too few sizes, the median of the small shards
+    points = [(record["n_bytes"] / 1024 / 1024, record["max_rss_mb"]) for record in records if record["n_bytes"] > 0 and "max_rss_mb" in record]
+    large_points = [(size, rss) for size, rss in points if size >= MIN_RSS_FIT_MB]
+    small_rss = [rss for size, rss in points if size < MIN_RSS_FIT_MB]
+    base = median(small_rss) if len(small_rss) > 0 else DEFAULT_TOKENIZE_RSS_BASE_MB
+
+    if len({size for size, _ in large_points}) >= 2:
+        mean_size = sum(size for size, _ in large_points) / len(large_points)
+        mean_rss = sum(rss for _, rss in large_points) / len(large_points)
+        slope = sum((size - mean_size) * (rss - mean_rss) for size, rss in large_points) / sum((size - mean_size) ** 2 for size, _ in large_points)
+        if slope > 0:
+            return max(0.0, mean_rss - slope * mean_size), slope
+
+    if len(large_points) > 0:
+        return base, median([max(0.0, rss - base) / size for size, rss in large_points])
+    return base, DEFAULT_TOKENIZE_RSS_PER_MB
+
+
+class CostModel:
+    def __init__(self, records=()):
+        shard_records = [record for record in records if record["stage"] == "shard"]
+        tokenizer_records = [record for record in records if record["stage"] == "tokenizer"]
+        tokenize_records = [record for record in records if record["stage"] == "tokenize"]
+        self.train_records = [record for record in records if record["stage"] == "train" and record["steps"] > 0]
+
+        self.n_records = {"shard": len(shard_records), "tokenizer": len(tokenizer_records), "tokenize": len(tokenize_records), "train": len(self.train_records)}
+
+        self.shard_mb_per_second = rate(shard_records, "n_bytes", "seconds", DEFAULT_SHARD_MB_PER_SECOND * 1024 * 1024) / 1024 / 1024
+        self.shard_documents_per_second = rate(shard_records, "n_documents", "seconds", None)
+        self.tokenizer_seconds = median([record["seconds"] for record in tokenizer_records]) if len(tokenizer_records) > 0 else DEFAULT_TOKENIZER_SECONDS
+        self.tokenize_mb_per_second = rate(tokenize_records, "n_bytes", "seconds", DEFAULT_TOKENIZE_MB_PER_SECOND * 1024 * 1024) / 1024 / 1024
+        self.tokenize_subwords_per_second = rate(tokenize_records, "n_subwords", "seconds", None)
+        self.subwords_per_byte = rate(tokenize_records, "n_subwords", "n_bytes", DEFAULT_SUBWORDS_PER_BYTE)
+        self.tokenize_rss_base_mb, self.tokenize_rss_per_mb = fit_tokenize_memory(tokenize_records)
+
+    @classmethod
+    def from_records(cls, pattern):
+        return cls(read_throughput_records(pattern))
+
+    def shard_seconds(self, size_mb):
+        return size_mb / self.shard_mb_per_second
+
+    def tokenize_seconds(self, size_mb):
+        return size_mb / self.tokenize_mb_per_second
+
+    def tokenize_rss_mb(self, size_mb):
+        return self.tokenize_rss_base_mb + self.tokenize_rss_per_mb * size_mb
+
+    def tokenize_ranks_per_node(self, size_mb):
+        # as many tokenization ranks as fit into one node, by cores and by their peak memory
+        return max(1, min(CORES_PER_NODE // TOKENIZE_CORES_PER_RANK, int(MEMORY_PER_NODE_MB // self.tokenize_rss_mb(size_mb))))
+
+    def n_subwords(self, size_mb):
+        return size_mb * 1024 * 1024 * self.subwords_per_byte
+
+    def train_steps_per_second(self, config, n_gpus):
+        # the measurement with the same config and the closest number of GPUs, the steps are assumed to scale weakly
+        # (every GPU processes its own batch_size), so the throughput of the closest measurement is reused as it is
+        records = [record for record in self.train_records if record["config"] == config]
+        if len(records) == 0:
+            return None
+        closest_n_gpus = min(records, key=lambda record: abs(record["n_gpus"] - n_gpus))["n_gpus"]
+        return rate([record for record in records if record["n_gpus"] == closest_n_gpus], "steps", "seconds", None)
+
+    def preprocessing_core_hours(self, total_size):
+        return (
+            SHARD_CORES * self.shard_seconds(total_size)
+            + TOKENIZER_CORES * self.tokenizer_seconds
+            + TOKENIZE_CORES_PER_RANK * self.tokenize_seconds(total_size)
+        ) / 3600
+
+    def describe(self):
+        lines = [
+            f"sharding: {self.shard_mb_per_second:.1f} MB/s" + (f", {self.shard_documents_per_second:,.0f} docs/s" if self.shard_documents_per_second is not None else "") + f" per job ({self.n_records['shard']} records)",
+            f"tokenizer training: {self.tokenizer_seconds / 3600:.2f} h ({self.n_records['tokenizer']} records)",
+            f"tokenization: {self.tokenize_mb_per_second:.2f} MB/s" + (f", {self.tokenize_subwords_per_second:,.0f} subwords/s" if self.tokenize_subwords_per_second is not None else "") + f" per rank, {self.subwords_per_byte:.3f} subwords per byte, peak memory {self.tokenize_rss_base_mb:,.0f} MB + {self.tokenize_rss_per_mb:.1f}x the shard size ({self.n_records['tokenize']} records)",
+        ]
+        for config, n_gpus in sorted({(record["config"], record["n_gpus"]) for record in self.train_records}):
+            lines.append(f"training: {self.train_steps_per_second(config, n_gpus):.2f} steps/s with {config} on {n_gpus} GPUs")
+        if len(self.train_records) == 0:
+            lines.append("training: no records")
+        return '\n'.join(lines)
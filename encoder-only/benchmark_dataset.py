@@ -0,0 +1,139 @@
+# measures how many training samples per second the CPU data pipeline produces for one tokenized shard:
+# the per-sample path (Dataset.__getitem__ and the default collate) against the batched path (Dataset.get_batch),
+# both followed by the batched span masking like in train.py (there on the GPU);
+# with --num_workers, it also checks that two runs with the same seed give the same batches from the DataLoader workers
+#
+# with --check_worker_crash, it runs the regression check of worker_check.py: the forked workers have to crash after
+# the GPU initialization (exit status 0), the --worker_start_method workers must not (1), and 2 means that the
+# forked ones didn't crash either
+#
+# usage: python3 benchmark_dataset.py --input_file /scratch/project_465000498/processed_data/nn/tokenized_shards/train_00000.pt.gz
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from tokenizers import Tokenizer
+
+from dataset import Dataset, SpanMaskingStrategy, RandomBatchSampler, seed_worker
+from worker_check import initialize_like_training, run_child, describe_exit, check_outcome
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_file', type=str, required=True, help='A tokenized training shard')
+    parser.add_argument('--tokenizer_path', type=str, default=None, help='Defaults to tokenizer.json next to the tokenized_shards directory')
+    parser.add_argument('--seq_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--n_batches', type=int, default=50, help='Number of measured batches for every path')
+    parser.add_argument('--short_p', type=float, default=0.1)
+    parser.add_argument('--packing', action='store_true')
+    parser.add_argument('--mask_random_p', type=float, default=0.1)
+    parser.add_argument('--mask_keep_p', type=float, default=0.1)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--worker_start_method', type=str, default="spawn", choices=["spawn", "forkserver", "fork"])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--check_worker_crash', action='store_true', help='Compare forked and --worker_start_method workers after the GPU is initialized')
+    parser.add_argument('--worker_check', action='store_true', help=argparse.SUPPRESS)  # the child process of --check_worker_crash
+    args = parser.parse_args()
+    if args.check_worker_crash and args.worker_start_method == "fork":
+        parser.error("--check_worker_crash compares fork with another --worker_start_method")
+
+    if args.tokenizer_path is None:
+        args.tokenizer_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(args.input_file))), "tokenizer.json")
+    return args
+
+
+def measure(dataloader, masking_strategy, n_batches, batch_size):
+    iterator = iter(dataloader)
+    next(iterator)  # warm up
+
+    start_time = time.perf_counter()
+    for _ in range(n_batches):
+        input_ids = next(iterator)[0]
+        masking_strategy(input_ids.t())
+    return n_batches * batch_size / (time.perf_counter() - start_time)
+
+
+def batched_loader(dataset, args):
+    # the same DataLoader as in train.py
+    return DataLoader(
+        dataset, batch_size=None,
+        sampler=RandomBatchSampler(len(dataset), args.batch_size, torch.Generator().manual_seed(args.seed)),
+        num_workers=args.num_workers,
+        multiprocessing_context=args.worker_start_method if args.num_workers > 0 else None,
+        worker_init_fn=seed_worker,
+        generator=torch.Generator().manual_seed(args.seed),
+    )
+
+
+def is_reproducible(dataset, args, n_batches=8):
+    batches = []
+    for _ in range(2):
+        iterator = iter(batched_loader(dataset, args))
+        batches.append([next(iterator) for _ in range(n_batches)])
+    return all(
+        torch.equal(first, second)
+        for first_batch, second_batch in zip(*batches)
+        for first, second in zip(first_batch, second_batch)
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+
+    if args.check_worker_crash:
+        num_workers = max(args.num_workers, 2)
+        arguments = [arg for arg in sys.argv[1:] if arg != "--check_worker_crash"] + ["--worker_check", f"--num_workers={num_workers}"]
+        results = {
+            start_method: run_child(__file__, arguments + [f"--worker_start_method={start_method}"])
+            for start_method in ["fork", args.worker_start_method]
+        }
+        for start_method, returncode in results.items():
+            print(f"{num_workers} {start_method} workers after the GPU initialization: {describe_exit(returncode)}", flush=True)
+
+        status, message = check_outcome(results["fork"], results[args.worker_start_method], args.worker_start_method)
+        print(message, flush=True)
+        exit(status)
+
+    stop_threads = initialize_like_training() if args.worker_check else None
+
+    tokenizer = Tokenizer.from_file(args.tokenizer_path)
+    args.vocab_size = tokenizer.get_vocab_size()
+    args.n_special_tokens = tokenizer.token_to_id("[MASK_99]") + 2
+
+    dataset = Dataset(args.input_file, tokenizer, args)
+    masking_strategy = SpanMaskingStrategy(args.n_special_tokens, args.mask_random_p, args.mask_keep_p, args.vocab_size, tokenizer.token_to_id("[MASK]"))
+    print(f"Loaded {len(dataset)} segments in {dataset.load_time:.1f} s, {dataset.memory_overhead():.2f} bytes of index per token", flush=True)
+
+    if args.worker_check:
+        # a few batches, then the workers are shut down, which is where the forked ones used to crash
+        iterator = iter(batched_loader(dataset, args))
+        for _ in range(8):
+            input_ids = next(iterator)[0]
+            if torch.cuda.is_available():
+                masking_strategy(input_ids.t().cuda())
+        del iterator
+        stop_threads.set()
+        exit(0)
+
+    per_sample_loader = DataLoader(
+        dataset, shuffle=True, batch_size=args.batch_size, drop_last=True,
+        generator=torch.Generator().manual_seed(args.seed)
+    )
+
+    per_sample_throughput = measure(per_sample_loader, masking_strategy, args.n_batches, args.batch_size)
+    batched_throughput = measure(batched_loader(dataset, args), masking_strategy, args.n_batches, args.batch_size)
+
+    print(f"per-sample: {per_sample_throughput:,.0f} samples/s", flush=True)
+    print(f"batched ({args.num_workers} workers): {batched_throughput:,.0f} samples/s ({batched_throughput / per_sample_throughput:.1f}x)", flush=True)
+
+    if args.num_workers > 0:
+        if not is_reproducible(dataset, args):
+            print(f"ERROR: the batches of {args.num_workers} {args.worker_start_method} workers differ between two runs with the same seed", flush=True)
+            exit(1)
+        print(f"The batches of {args.num_workers} {args.worker_start_method} workers are reproducible", flush=True)
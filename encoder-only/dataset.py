@@ -1,5 +1,14 @@
 import torch
 import gzip
+import os
+import math
+import time
+import random
+import tempfile
+import threading
+import numpy as np
+
+from utils import flat_paths
 
 
 def apply_mask(args, input_ids, mask_ratios, replacement_ids, global_step):
@@ -23,75 +32,281 @@ class SpanMaskingStrategy:
         self.vocab_size = vocab_size
         self.mask_token_id = mask_token_id
 
-    def __call__(self, tokens):
-        replacement_tokens = tokens.clone()
-        length = tokens.size(0)
+    def __call__(self, tokens, generator=None):
+        # masks a whole [seq_length, batch_size] batch (or a single [seq_length] sequence) on the device it is on;
+        # every sequence is covered by spans of 1-10 subwords that share their random numbers; the generator has
+        # to be on the same device
+        is_single = tokens.dim() == 1
+        if is_single:
+            tokens = tokens.unsqueeze(1)
+        length, batch_size = tokens.shape
+        n_spans = length // 2
+
+        span_lengths = torch.zeros([n_spans, batch_size], device=tokens.device).geometric_(0.2, generator=generator) % 11
+        span_lengths = span_lengths.clamp(1, 10).long()
+        span_random_numbers_1 = torch.rand([n_spans, batch_size], device=tokens.device, generator=generator)
+        span_random_numbers_2 = torch.rand([n_spans, batch_size], device=tokens.device, generator=generator)
 
-        preservation_mask = tokens < self.n_special_tokens
+        # the span of every position is the number of spans ending before or at it, the positions after the last
+        # span belong to it as well
+        span_ends = span_lengths.cumsum(dim=0).t().contiguous()
+        positions = torch.arange(length, device=tokens.device).expand(batch_size, length).contiguous()
+        indices = torch.searchsorted(span_ends, positions, right=True).t().clamp(max=n_spans - 1)
 
-        span_lengths = torch.zeros([length // 2]).geometric_(0.2) % 11
-        span_lengths = span_lengths.clamp(1, 10).long()
-        span_random_numbers_1 = torch.rand([length // 2])
-        span_random_numbers_2 = torch.rand([length // 2])
-
-        indices = torch.repeat_interleave(torch.arange(span_lengths.size(0)), span_lengths)
-        indices = indices[:length]
-        if indices.size(0) < length:
-            indices = torch.cat([indices, torch.full([length - indices.size(0)], fill_value=length // 2 - 1, dtype=torch.long)])
-        
-        mask_ratios = span_random_numbers_1[indices]
-        mask_ratios[preservation_mask] = 1.0
-
-        replacement_p = span_random_numbers_2[indices]
-        random_mask = replacement_p < self.random_p
-        replacement_tokens[random_mask] = torch.randint(
-            low=self.n_special_tokens,
-            high=self.vocab_size,
-            size=[random_mask.sum().item()],
-            dtype=torch.long
-        )
-        replacement_tokens[replacement_p > (self.random_p + self.keep_p)] = self.mask_token_id
+        preservation_mask = tokens < self.n_special_tokens
+        mask_ratios = span_random_numbers_1.gather(0, indices)
+        mask_ratios = torch.where(preservation_mask, 1.0, mask_ratios)
 
+        replacement_p = span_random_numbers_2.gather(0, indices)
+        random_tokens = torch.randint(self.n_special_tokens, self.vocab_size, tokens.shape, device=tokens.device, generator=generator)
+        replacement_tokens = torch.where(replacement_p < self.random_p, random_tokens, tokens)
+        replacement_tokens = torch.where(replacement_p > (self.random_p + self.keep_p), self.mask_token_id, replacement_tokens)
 
+        if is_single:
+            return mask_ratios.squeeze(1), replacement_tokens.squeeze(1)
         return mask_ratios, replacement_tokens
 
 
-class Dataset(torch.utils.data.Dataset):
+def is_flat_valid(input_file):
+    # the flat arrays are valid if they are at least as new as the shard (or the shard isn't there, e.g. when staged)
+    tokens_path, offsets_path = flat_paths(input_file)
+    if not os.path.exists(tokens_path) or not os.path.exists(offsets_path):
+        return False
+    if not os.path.exists(input_file):
+        return True
+    return min(os.path.getmtime(tokens_path), os.path.getmtime(offsets_path)) >= os.path.getmtime(input_file)
+
+
+def convert_to_flat(input_file):
+    # shards tokenized before the flat arrays existed are converted once, every rank loading the same shard
+    # writes its own temporary files and renames them into place, so concurrent conversions are harmless
+    with gzip.GzipFile(input_file, 'rb') as f:
+        documents = torch.load(f)
+
+    tokens = torch.cat(documents).numpy() if len(documents) > 0 else np.zeros(0, dtype=np.int16)
+    offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(document) for document in documents])
+    del documents
+
+    try:
+        for path, array in zip(flat_paths(input_file), [tokens, offsets]):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path))
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+    except OSError as error:
+        print(f"WARNING: couldn't save the flat arrays of {input_file} ({error}), keeping them in memory", flush=True)
+
+    return tokens, offsets
+
+
+def load_flat(input_file):
+    # returns the memory-mapped tokens of all documents and their offsets
+    if not is_flat_valid(input_file):
+        tokens, offsets = convert_to_flat(input_file)
+        if not is_flat_valid(input_file):
+            return tokens, offsets
+
+    tokens_path, offsets_path = flat_paths(input_file)
+    tokens, offsets = np.load(tokens_path, mmap_mode='r'), np.load(offsets_path)
+    assert offsets[-1] == len(tokens), f"{tokens_path} doesn't match {offsets_path}"
+    return tokens, offsets
+
+
+class DatasetPrefetcher:
+    # builds the dataset of the next epoch in a background thread while the current epoch trains, and reads its
+    # memory-mapped tokens into the page cache (the file reads and the numpy work mostly release the GIL);
+    # a prefetch that is never asked for is simply dropped
+    def __init__(self):
+        self.key, self.thread, self.result = None, None, None
+
+    def prefetch(self, key, build):
+        if key == self.key:
+            return
+
+        result = {}
+
+        def run():
+            try:
+                result["dataset"] = build()
+            except Exception as error:
+                print(f"WARNING: prefetching {key} failed ({error}), it will be loaded at the start of its epoch", flush=True)
+
+        self.key, self.result = key, result
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def get(self, key):
+        # the prefetched dataset if it was built for the same key, None otherwise
+        if key != self.key:
+            return None
+        self.thread.join()
+        dataset = self.result.get("dataset")
+        self.key, self.thread, self.result = None, None, None
+        return dataset
+
+
+def seed_worker(worker_id):
+    # DataLoader seeds torch in every worker with a base seed from its generator (seeded with train_seed) + worker_id,
+    # numpy and random follow the same seed
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class MemoryMappedSegments:
+    # the segments of the flat token array: windows of (seq_length - 2) subwords with a stride of half a window,
+    # for every non-empty document, in the order of the documents; they are computed on demand from the document
+    # offsets, so only the number of segments per document depends on the sequence length
+    #
+    # safe to send to DataLoader workers (forked or spawned), the tokens are not pickled but memory-mapped again
+    # in every worker, only the offsets are copied
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.tokens, np.memmap):
+            state["tokens"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.tokens is None:
+            self.tokens = np.load(self.tokens_path, mmap_mode='r')
+
+    def load_segments(self, input_file, seq_length):
+        self.tokens, self.offsets = load_flat(input_file)
+        self.tokens_path = flat_paths(input_file)[0]
+        self.first_index, self.index_step = 0, 1  # used segments: first_index, first_index + index_step, ...
+        self.set_seq_length(seq_length)
+
+    def set_seq_length(self, seq_length):
+        self.seq_length = seq_length
+        self.stride = (seq_length - 2) // 2
+        n_segments = (np.diff(self.offsets) + self.stride - 1) // self.stride
+        self.segment_ends = np.cumsum(n_segments)  # the index after the last segment of every document
+
+    def segment_bounds(self, indices):
+        indices = self.first_index + np.asarray(indices, dtype=np.int64) * self.index_step
+        documents = np.searchsorted(self.segment_ends, indices, side='right')
+        first_segments = np.where(documents > 0, self.segment_ends[documents - 1], 0)
+        starts = self.offsets[documents] + (indices - first_segments) * self.stride
+        lengths = np.minimum(self.offsets[documents + 1] - starts, self.seq_length - 2)
+        return starts, lengths
+
+    def segment(self, index):
+        start, length = self.segment_bounds(index)
+        return torch.from_numpy(self.tokens[start : start + length].astype(np.int64))
+
+    def read_tokens(self, chunk_size=16 * 1024 * 1024):
+        # reads the memory-mapped tokens once, sequentially, so that the random segments of the first batches are
+        # served from the page cache instead of page faults on the shared filesystem
+        if not isinstance(self.tokens, np.memmap):
+            return
+        with open(self.tokens_path, "rb") as f:
+            while f.read(chunk_size):
+                pass
+
+    def memory_overhead(self):
+        # bytes held in memory per token, the tokens themselves are memory-mapped
+        return (self.offsets.nbytes + self.segment_ends.nbytes) / max(1, len(self.tokens))
+
+    def __len__(self):
+        n_segments = self.segment_ends[-1].item() if len(self.segment_ends) > 0 else 0
+        return n_segments // self.index_step
+
+
+class PlannedBatchSampler:
+    # yields (seed, batch) pairs of batches that are all planned up front; every batch is built with its own random
+    # generator, so the sampler can start at any batch (start_batch, used when resuming from a checkpoint) and the
+    # remaining batches are exactly the same as without the interruption
+    def plan(self, batches, generator):
+        self.batches = batches
+        self.seeds = torch.randint(0, 2**62, [len(batches)], generator=generator).tolist()
+        self.start_batch = 0
+
+    def __len__(self):
+        return len(self.batches) - self.start_batch
+
+    def __iter__(self):
+        return zip(self.seeds[self.start_batch:], self.batches[self.start_batch:])
+
+
+class RandomBatchSampler(PlannedBatchSampler):
+    # the same batches as BatchSampler(RandomSampler(...), batch_size, drop_last=True) with the same generator
+    def __init__(self, n_samples, batch_size, generator):
+        order = torch.randperm(n_samples, generator=generator).tolist()
+        self.plan([order[i : i + batch_size] for i in range(0, n_samples - batch_size + 1, batch_size)], generator)
+
+
+class TokenBudgetBatchSampler(PlannedBatchSampler):
+    # draws the target length of every sample up front (the same short_p distribution as Dataset.get_batch),
+    # groups the samples into length buckets and fills every batch with as many samples of one bucket as fit into
+    # token_budget subwords, including [CLS], [SEP] and the padding to the longest length of the bucket;
+    # its batches are lists of (index, target length) pairs
+    def __init__(self, n_samples, seq_length, short_p, token_budget, generator, n_buckets=8):
+        max_length = seq_length - 2
+        order = torch.randperm(n_samples, generator=generator)
+        is_short = torch.rand([n_samples], generator=generator) <= short_p
+        target_lengths = torch.where(is_short, torch.randint(1, max_length, [n_samples], generator=generator), max_length)[order]
+        buckets = (target_lengths - 1) * n_buckets // max_length
+
+        batches = []
+        for bucket in range(n_buckets):
+            bucket_max_length = -(-(bucket + 1) * max_length // n_buckets)
+            batch_size = max(1, token_budget // (bucket_max_length + 2))
+            is_in_bucket = buckets == bucket
+            samples = list(zip(order[is_in_bucket].tolist(), target_lengths[is_in_bucket].tolist()))
+            batches += [samples[i : i + batch_size] for i in range(0, len(samples) - batch_size + 1, batch_size)]
+
+        self.plan([batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()], generator)
+
+
+class Dataset(MemoryMappedSegments, torch.utils.data.Dataset):
     def __init__(self, input_file: str, tokenizer, args):
         self.path = input_file
-        self.seq_length = args.seq_length
         self.short_p = args.short_p
         self.n_special_tokens = args.n_special_tokens
+        self.packing = args.packing
+        self.min_packed_length = 8  # a packed row isn't filled with segments shorter than this
 
         self.mask_index = tokenizer.token_to_id("[MASK]")
         self.cls_index = tokenizer.token_to_id("[CLS]")
         self.sep_index = tokenizer.token_to_id("[SEP]")
         self.pad_index = tokenizer.token_to_id("[PAD]")
 
-        self.masking_strategy = SpanMaskingStrategy(args.n_special_tokens, args.mask_random_p, args.mask_keep_p, args.vocab_size, self.mask_index)
+        start_time = time.time()
+        self.load_segments(input_file, args.seq_length)
+        self.load_time = time.time() - start_time
 
-        with gzip.GzipFile(input_file, 'rb') as f:
-            documents = torch.load(f)
-
-        self.segments = [
-            document[offset : offset + self.seq_length - 2]
-            for document in documents
-            for offset in range(0, len(document), (self.seq_length - 2) // 2)
-            if len(document) > 0
-        ]
-
-    def __len__(self):
-        return len(self.segments)
+    def gather_segments(self, indices):
+        # the segments padded to (seq_length - 2) subwords, with their lengths
+        starts, lengths = self.segment_bounds(indices)
+        token_indices = np.minimum(starts[:, None] + np.arange(self.seq_length - 2)[None, :], len(self.tokens) - 1)
+        return torch.from_numpy(self.tokens[token_indices].astype(np.int64)), torch.from_numpy(lengths)
 
     def __getitem__(self, index):
-        tokens = self.segments[index]
+        # a (seed, list of indices) pair comes from a PlannedBatchSampler (with DataLoader(batch_size=None)), the whole
+        # batch is built at once, with its own random generator
+        if isinstance(index, tuple):
+            seed, index = index
+            generator = torch.Generator().manual_seed(seed)
+            if self.packing:
+                return self.get_packed_batch(index, generator)
+            if isinstance(index[0], tuple):
+                # (index, target length) pairs from TokenBudgetBatchSampler
+                indices, target_lengths = zip(*index)
+                return self.get_batch(list(indices), torch.tensor(target_lengths), generator)
+            return self.get_batch(index, generator=generator)
+        if self.packing:
+            return tuple(tensor[0] for tensor in self.get_packed_batch([index]))
+
+        tokens = self.segment(index)
 
         target_seq_length = self.seq_length - 2 if torch.rand([]).item() > self.short_p else torch.randint(1, self.seq_length - 2, []).item()
-        tokens = tokens[:target_seq_length].long()
+        tokens = tokens[:target_seq_length]
 
         while tokens.size(0) + 1 < target_seq_length:
-            new_index = torch.randint(0, len(self.segments), []).item()
-            new_tokens = self.segments[new_index].long()
+            new_index = torch.randint(0, len(self), []).item()
+            new_tokens = self.segment(new_index)
             tokens = torch.cat([tokens, torch.LongTensor([self.sep_index]), new_tokens], dim=0)
             tokens = tokens[:target_seq_length]
 
@@ -108,22 +323,251 @@ class Dataset(torch.utils.data.Dataset):
             torch.ones(padding_length, dtype=torch.bool)
         ])
 
-        mask_ratios, replacement_tokens = self.masking_strategy(segment)
-
-        return segment, attention_mask, mask_ratios, replacement_tokens
-
-    def show_random_item(self, tokenizer):
-        inputs, _, mask_ratios, replacement_tokens = self.__getitem__(torch.randint(0, len(self), []).item())
+        return segment, attention_mask
+
+    def get_batch(self, indices, target_lengths=None, generator=None):
+        # the same samples as from __getitem__ (drawn in a different order from the random generator), but built
+        # for the whole batch in preallocated tensors; returns them already collated to [batch_size, seq_length],
+        # or only as long as the longest target length when the lengths come from TokenBudgetBatchSampler
+        batch_size, max_length = len(indices), self.seq_length - 2
+        positions = torch.arange(max_length)
+
+        if target_lengths is None:
+            is_short = torch.rand([batch_size], generator=generator) <= self.short_p
+            target_lengths = torch.where(is_short, torch.randint(1, max_length, [batch_size], generator=generator), max_length)
+            row_length = self.seq_length
+        else:
+            row_length = target_lengths.max().item() + 2
+
+        tokens, lengths = self.gather_segments(np.asarray(indices))
+        lengths = torch.minimum(lengths, target_lengths)
+
+        # append [SEP] and a random segment to the rows that are still too short, cut at their target lengths
+        while True:
+            rows = (lengths + 1 < target_lengths).nonzero().squeeze(1)
+            if rows.size(0) == 0:
+                break
+
+            new_tokens, new_lengths = self.gather_segments(torch.randint(0, len(self), [rows.size(0)], generator=generator).numpy())
+            tokens[rows, lengths[rows]] = self.sep_index
+
+            write_positions = lengths[rows, None] + 1 + positions[None, :]
+            is_written = (positions[None, :] < new_lengths[:, None]) & (write_positions < target_lengths[rows, None])
+            tokens[rows[:, None].expand_as(write_positions)[is_written], write_positions[is_written]] = new_tokens[is_written]
+            lengths[rows] = torch.minimum(lengths[rows] + 1 + new_lengths, target_lengths[rows])
+
+        segments = torch.full([batch_size, self.seq_length], self.pad_index, dtype=torch.long)
+        segments[:, 0] = self.cls_index
+        segments[:, 1:-1] = torch.where(positions[None, :] < lengths[:, None], tokens, self.pad_index)
+        segments[torch.arange(batch_size), lengths + 1] = self.sep_index
+
+        attention_mask = torch.arange(self.seq_length)[None, :] >= (lengths[:, None] + 2)
+
+        return segments[:, :row_length], attention_mask[:, :row_length]
+
+    def get_packed_batch(self, indices, generator=None):
+        # fills every row with several segments, each as [CLS] subwords [SEP] with its own segment id (0 for the
+        # padding), the model masks the attention between different segments; short sequences come from the
+        # ends of the documents here instead of from short_p, only the last segment of a row is cut to fit
+        batch_size = len(indices)
+        positions = torch.arange(self.seq_length)
+
+        segments = torch.full([batch_size, self.seq_length], self.pad_index, dtype=torch.long)
+        segment_ids = torch.zeros([batch_size, self.seq_length], dtype=torch.long)
+        lengths = torch.zeros([batch_size], dtype=torch.long)
+        n_segments = torch.zeros([batch_size], dtype=torch.long)
+
+        rows, next_indices = torch.arange(batch_size), np.asarray(indices)
+        while rows.size(0) > 0:
+            new_tokens, new_lengths = self.gather_segments(next_indices)
+            new_lengths = torch.minimum(new_lengths, self.seq_length - 2 - lengths[rows])
+            n_segments[rows] += 1
+
+            packed = torch.cat([
+                torch.full([rows.size(0), 1], self.cls_index, dtype=torch.long),
+                new_tokens,
+                torch.full([rows.size(0), 1], self.pad_index, dtype=torch.long)
+            ], dim=1)
+            packed[torch.arange(rows.size(0)), new_lengths + 1] = self.sep_index
+
+            write_positions = lengths[rows, None] + positions[None, :]
+            is_written = positions[None, :] < (new_lengths[:, None] + 2)
+            written_rows = rows[:, None].expand_as(write_positions)[is_written]
+            segments[written_rows, write_positions[is_written]] = packed[is_written]
+            segment_ids[written_rows, write_positions[is_written]] = n_segments[rows, None].expand_as(write_positions)[is_written]
+            lengths[rows] += new_lengths + 2
+
+            rows = rows[self.seq_length - 2 - lengths[rows] >= self.min_packed_length]
+            next_indices = torch.randint(0, len(self), [rows.size(0)], generator=generator).numpy()
+
+        attention_mask = positions[None, :] >= lengths[:, None]
+
+        return segments, attention_mask, segment_ids
+
+    def show_random_item(self, tokenizer, masking_strategy):
+        # doesn't touch the random state of the training, a resumed run has to draw the same numbers as an uninterrupted one
+        with torch.random.fork_rng(devices=[]):
+            inputs = self.__getitem__(torch.randint(0, len(self), []).item())[0]
+            mask_ratios, replacement_tokens = masking_strategy(inputs)
         print(' '.join(tokenizer.decode([i], skip_special_tokens=False) for i in inputs.tolist()), flush=True)
         print(' '.join(str(i) for i in inputs.tolist()), flush=True)
         print(' '.join(tokenizer.decode([i], skip_special_tokens=False) for i in replacement_tokens.tolist()), flush=True)
         print(mask_ratios, flush=True)
 
 
-class ValidationDataset(torch.utils.data.Dataset):
+class EpochBatchSampler:
+    # the sampler of the one DataLoader kept for the whole training (its workers are persistent, spawning them for every
+    # epoch and training phase is slow): it yields the (seed, batch) pairs of the current epoch's sampler, together with
+    # the shard and the sequence length they are for
+    def __init__(self):
+        self.sampler, self.path, self.seq_length = None, None, None
+
+    def set_epoch(self, sampler, path, seq_length):
+        self.sampler, self.path, self.seq_length = sampler, path, seq_length
+
+    @property
+    def start_batch(self):
+        return self.sampler.start_batch
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        path, seq_length = self.path, self.seq_length
+        return ((path, seq_length, seed, batch) for seed, batch in self.sampler)
+
+
+class EpochDataset(torch.utils.data.Dataset):
+    # the dataset of the kept DataLoader: every worker memory-maps the shard of the current epoch when its first batch
+    # comes (only the document offsets are read), and recomputes its segments when the sequence length changes
+    def __init__(self, tokenizer, args):
+        self.tokenizer = tokenizer
+        self.args = args
+        self.dataset = None
+
+    def __getitem__(self, index):
+        path, seq_length, seed, batch = index
+        if self.dataset is None or self.dataset.path != path:
+            self.dataset = None  # unmaps the previous shard first
+            self.args.seq_length = seq_length
+            self.dataset = Dataset(path, self.tokenizer, self.args)
+        elif self.dataset.seq_length != seq_length:
+            self.dataset.set_seq_length(seq_length)
+        return self.dataset[(seed, batch)]
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    # one endless stream of training batches over all shards of a rank, instead of one shard per epoch: the shard at
+    # stream position p is (rank + p * world_size + shard_offset) % n_training_files, from start_position on;
+    # a random half of the segments of every shard (they overlap by half) goes through a bounded shuffle buffer,
+    # which mixes the end of one shard with the start of the next one
+    #
+    # every worker plans the same sequence of batches (only indices, that is cheap) and builds every n-th of them,
+    # so the DataLoader returns them in the planned order; every batch ends with the newest stream position in it
+    #
+    # the shards are waited for before the stream starts, by the main process of every rank together (see
+    # set_ready_shards), the DataLoader workers never wait: they would block the collectives of the other ranks
+    def __init__(self, tokenizer, args, rank, world_size, shard_offset, start_position, batch_size, seed, buffer_size=65536):
+        self.tokenizer = tokenizer
+        self.args = args
+        self.rank, self.world_size, self.shard_offset = rank, world_size, shard_offset
+        self.start_position = start_position
+        self.batch_size = batch_size
+        self.seed = seed
+        self.buffer_size = max(buffer_size, batch_size)
+        self.ready_shards = None
+
+    def shard_path(self, position):
+        index = (self.rank + position * self.world_size + self.shard_offset) % self.args.n_training_files
+        return f"{self.args.input_dir}/tokenized_shards/train_{index:05d}.pt.gz", index
+
+    def cycle_positions(self):
+        # the stream visits the same shards over and over, in cycles of this many positions (equal for all ranks)
+        cycle_length = self.args.n_training_files // math.gcd(self.world_size, self.args.n_training_files)
+        return range(self.start_position, self.start_position + cycle_length)
+
+    def set_ready_shards(self, ready_shards):
+        # the indices of the shards of one cycle that were ready when the stream started, the others are skipped
+        if len(ready_shards) == 0:
+            raise RuntimeError("None of the training shards exist")
+        self.ready_shards = set(ready_shards)
+
+    def shards(self):
+        # yields (stream position, dataset, segment order) for every usable shard, forever
+        assert self.ready_shards is not None, "set_ready_shards has to be called before the stream starts"
+        position = self.start_position
+        while True:
+            path, index = self.shard_path(position)
+            if index not in self.ready_shards:
+                if position in self.cycle_positions():
+                    print(f"WARNING: training shard at stream position {position} is not ready, skipping it", flush=True)
+            else:
+                dataset = Dataset(path, self.tokenizer, self.args)
+                order = np.random.default_rng([self.seed, position]).permutation(len(dataset))[:len(dataset) // 2]
+                yield position, dataset, order
+            position += 1
+
+    def planned_batches(self):
+        # yields (datasets, positions, indices) of every planned batch, the buffer holds (position, index) pairs
+        rng = np.random.default_rng([self.seed, self.start_position, self.batch_size])
+        buffer_positions, buffer_indices = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pending_positions, pending_indices = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        datasets = {}
+
+        for position, dataset, order in self.shards():
+            # forget the shards that have no segments left in the buffer or in the unfinished batch
+            datasets = {
+                old_position: old_dataset for old_position, old_dataset in datasets.items()
+                if (buffer_positions == old_position).any() or (pending_positions == old_position).any()
+            }
+            datasets[position] = dataset
+
+            for chunk_start in range(0, len(order), self.batch_size):
+                chunk = order[chunk_start : chunk_start + self.batch_size]
+                n_free = max(0, self.buffer_size - len(buffer_indices))
+                buffer_positions = np.concatenate([buffer_positions, np.full(min(n_free, len(chunk)), position)])
+                buffer_indices = np.concatenate([buffer_indices, chunk[:n_free]])
+                chunk = chunk[n_free:]
+                if len(chunk) == 0:
+                    continue
+
+                # every incoming segment replaces a random one from the buffer, which goes to the output
+                slots = rng.choice(self.buffer_size, len(chunk), replace=False)
+                pending_positions = np.concatenate([pending_positions, buffer_positions[slots]])
+                pending_indices = np.concatenate([pending_indices, buffer_indices[slots]])
+                buffer_positions[slots], buffer_indices[slots] = position, chunk
+
+                while len(pending_indices) >= self.batch_size:
+                    yield datasets, pending_positions[:self.batch_size], pending_indices[:self.batch_size]
+                    pending_positions, pending_indices = pending_positions[self.batch_size:], pending_indices[self.batch_size:]
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        for batch_number, (datasets, positions, indices) in enumerate(self.planned_batches()):
+            if batch_number % n_workers == worker_id:
+                yield self.build_batch(datasets, positions, indices, batch_number)
+
+    def build_batch(self, datasets, positions, indices, batch_number):
+        # the segments of every shard are built together, then concatenated; every batch has its own random generator,
+        # seeded by its place in the stream, so it doesn't depend on the worker that builds it (like PlannedBatchSampler)
+        batch_seed = np.random.default_rng([self.seed, self.rank, self.start_position, batch_number]).integers(2**62)
+        generator = torch.Generator().manual_seed(int(batch_seed))
+
+        parts = []
+        for position in np.unique(positions):
+            dataset = datasets[position]
+            shard_indices = indices[positions == position].tolist()
+            parts.append(dataset.get_packed_batch(shard_indices, generator) if dataset.packing else dataset.get_batch(shard_indices, generator=generator))
+
+        batch = [torch.cat(tensors, dim=0) for tensors in zip(*parts)]
+        return (*batch, torch.tensor(positions.max()))
+
+
+class ValidationDataset(MemoryMappedSegments, torch.utils.data.Dataset):
     def __init__(self, input_file: str, tokenizer, device_index, n_devices, args):
         self.path = input_file
-        self.seq_length = 128
         self.n_special_tokens = args.n_special_tokens
 
         self.mask_index = tokenizer.token_to_id("[MASK]")
@@ -131,28 +575,39 @@ class ValidationDataset(torch.utils.data.Dataset):
         self.sep_index = tokenizer.token_to_id("[SEP]")
         self.pad_index = tokenizer.token_to_id("[PAD]")
 
-        self.masking_strategy = SpanMaskingStrategy(args.n_special_tokens, args.mask_random_p, args.mask_keep_p, args.vocab_size, self.mask_index)
-
-        with gzip.GzipFile(input_file, 'rb') as f:
-            documents = torch.load(f)
-
-        self.segments = [
-            document[offset : offset + self.seq_length - 2]
-            for document in documents
-            for offset in range(0, len(document), (self.seq_length - 2) // 2)
-            if len(document) > 0
-        ]
-        self.segments = self.segments[:len(self.segments) // n_devices * n_devices]
-        self.segments = self.segments[device_index::n_devices]
-
-    def __len__(self):
-        return len(self.segments)
+        # every device validates on every n_devices-th segment
+        self.load_segments(input_file, 128)
+        self.first_index, self.index_step = device_index, n_devices
+        self.batches = None
+
+    def masked_batches(self, masking_strategy, args, device, batch_size=256, seed=42, pin_memory=False):
+        # the (input_ids, attention_mask, target_ids) batches, built and masked only once with a fixed seed: every
+        # validation epoch evaluates the same masked subwords, so the losses of different checkpoints are comparable;
+        # they are kept on the device, or in pinned memory with pin_memory
+        if self.batches is not None:
+            return self.batches
+
+        generator = torch.Generator(device=device).manual_seed(seed)
+        self.batches = []
+        for batch_start in range(0, len(self) - batch_size + 1, batch_size):
+            samples = [self[index] for index in range(batch_start, batch_start + batch_size)]
+            input_ids, attention_mask = [torch.stack(tensors).to(device) for tensors in zip(*samples)]
+            input_ids = input_ids.t()
+            mask_ratios, replacement_tokens = masking_strategy(input_ids, generator)
+            input_ids, target_ids, _ = apply_mask(args, input_ids, mask_ratios, replacement_tokens, args.max_steps)
+
+            batch = (input_ids, attention_mask, target_ids)
+            if pin_memory:
+                batch = tuple(tensor.cpu().pin_memory() for tensor in batch)
+            self.batches.append(batch)
+
+        return self.batches
 
     def __getitem__(self, index):
-        tokens = self.segments[index]
+        tokens = self.segment(index)
 
         target_seq_length = self.seq_length - 2
-        tokens = tokens[:target_seq_length].long()
+        tokens = tokens[:target_seq_length]
 
         padding_length = (self.seq_length - 2) - tokens.size(0)
         segment = torch.cat([
@@ -167,6 +622,4 @@ class ValidationDataset(torch.utils.data.Dataset):
             torch.ones(padding_length, dtype=torch.bool)
         ])
 
-        mask_ratios, replacement_tokens = self.masking_strategy(segment)
-
-        return segment, attention_mask, mask_ratios, replacement_tokens
+        return segment, attention_mask
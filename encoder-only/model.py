@@ -14,13 +14,19 @@ class Bert(nn.Module):
         self.transformer = Encoder(config, activation_checkpointing)
         self.classifier = MaskClassifier(config, self.embedding.word_embedding.weight)
 
-    def get_contextualized(self, input_ids, attention_mask):
+    def get_contextualized(self, input_ids, attention_mask, segment_ids=None):
         static_embeddings, relative_embedding = self.embedding(input_ids)
-        contextualized_embeddings = self.transformer(static_embeddings, attention_mask.unsqueeze(1).unsqueeze(2), relative_embedding)
+        if segment_ids is None:
+            attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        else:
+            # packed sequences, block-diagonal mask: every subword attends only to the subwords of its own segment
+            attention_mask = attention_mask.unsqueeze(1) | (segment_ids.unsqueeze(2) != segment_ids.unsqueeze(1))
+            attention_mask = attention_mask.unsqueeze(1)
+        contextualized_embeddings = self.transformer(static_embeddings, attention_mask, relative_embedding)
         return contextualized_embeddings
 
-    def forward(self, input_ids, attention_mask, masked_lm_labels=None):
-        contextualized_embeddings = self.get_contextualized(input_ids, attention_mask)
+    def forward(self, input_ids, attention_mask, masked_lm_labels=None, segment_ids=None):
+        contextualized_embeddings = self.get_contextualized(input_ids, attention_mask, segment_ids)
         subword_prediction = self.classifier(contextualized_embeddings, masked_lm_labels)
 
         gold_labels = masked_lm_labels.flatten()
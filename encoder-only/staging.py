@@ -0,0 +1,148 @@
+# copies the training shards a rank will need next from the shared filesystem (/scratch) to fast storage (/flash or a
+# node-local disk) in a background thread, so that switching to the next shard doesn't wait for Lustre;
+# the copies are verified against the sha256 from the .manifest.json written by preprocessing/tokenize_shards.py,
+# and evicted after their epoch; only the memory-mapped flat arrays are staged when they exist, not the gzipped shard
+
+import atexit
+import hashlib
+import os
+import shutil
+import threading
+
+from dataset import is_flat_valid
+from utils import flat_paths, is_shard_ready, manifest_path, read_json
+
+
+class ShardStager:
+    def __init__(self, staging_dir, poll_interval=30.0):
+        self.staging_dir = staging_dir
+        self.poll_interval = poll_interval  # how often to check whether a queued shard became ready
+
+        self.queue = []  # source paths waiting to be staged, in the order of their use
+        self.staged = {}  # source path -> verified local copy (its flat arrays might be the only files there)
+        self.in_progress = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def prefetch(self, paths):
+        with self.condition:
+            for path in paths:
+                if path not in self.staged and path != self.in_progress and path not in self.queue:
+                    self.queue.append(path)
+            self.condition.notify_all()
+
+    def get(self, path, wait=False):
+        # the local copy if it's ready (or being copied right now), otherwise the original path; with wait (used by the
+        # background prefetching of the next epoch), a shard that is still queued is waited for instead of dequeued
+        with self.condition:
+            while not self.closed and (self.in_progress == path or (wait and path in self.queue and is_shard_ready(path))):
+                self.condition.wait(timeout=self.poll_interval)
+            if path in self.queue:
+                self.queue.remove(path)
+            return self.staged.get(path, path)
+
+    def release(self, path):
+        with self.condition:
+            local_path = self.staged.pop(path, None)
+            if path in self.queue:
+                self.queue.remove(path)
+        if local_path is None:
+            return
+        for local_file in [local_path, *flat_paths(local_path)]:
+            if os.path.exists(local_file):
+                os.remove(local_file)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def _next_ready_path(self):
+        for path in self.queue:
+            if is_shard_ready(path):
+                return path
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                path = self._next_ready_path()
+                while not self.closed and path is None:
+                    self.condition.wait(timeout=self.poll_interval)
+                    path = self._next_ready_path()
+                if self.closed:
+                    return
+
+                self.queue.remove(path)
+                self.in_progress = path
+
+            try:
+                local_path = self._copy(path)
+            except OSError as error:
+                print(f"WARNING: staging {path} failed ({error}), reading it from the original location", flush=True)
+                local_path = None
+
+            with self.condition:
+                self.in_progress = None
+                if local_path is not None:
+                    self.staged[path] = local_path
+                self.condition.notify_all()
+
+    def _copy(self, path):
+        # copies the shard (or its flat arrays), returns None if the copy can't be used
+        manifest = read_json(manifest_path(path))
+        if manifest is None:
+            print(f"WARNING: {path} has no manifest, its staged copy can't be verified", flush=True)
+            manifest = {}
+
+        tokens_path, offsets_path = flat_paths(path)
+        if is_flat_valid(path):
+            sources = [(tokens_path, manifest.get("tokens_sha256")), (offsets_path, manifest.get("offsets_sha256"))]
+        else:
+            sources = [(path, manifest.get("output_sha256"))]
+
+        size = sum(os.path.getsize(source) for source, _ in sources)
+        if shutil.disk_usage(self.staging_dir).free < 2 * size:
+            print(f"WARNING: not enough space in {self.staging_dir} to stage {path}", flush=True)
+            return None
+
+        local_files = []
+        for source, expected_checksum in sources:
+            local_file = self._copy_file(source, expected_checksum)
+            if local_file is None:
+                for local_file in local_files:
+                    os.remove(local_file)
+                return None
+            local_files.append(local_file)
+
+        return os.path.join(self.staging_dir, os.path.basename(path))
+
+    def _copy_file(self, path, expected_checksum, chunk_size=16 * 1024 * 1024):
+        # copies and checksums in one pass
+        local_path = os.path.join(self.staging_dir, os.path.basename(path))
+        tmp_path = f"{local_path}.tmp"
+        sha256 = hashlib.sha256()
+        try:
+            with open(path, "rb") as f_in, open(tmp_path, "wb") as f_out:
+                for chunk in iter(lambda: f_in.read(chunk_size), b""):
+                    sha256.update(chunk)
+                    f_out.write(chunk)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if expected_checksum is not None and sha256.hexdigest() != expected_checksum:
+            print(f"WARNING: staged copy of {path} doesn't match its manifest checksum, reading it from the original location", flush=True)
+            os.remove(tmp_path)
+            return None
+
+        os.replace(tmp_path, local_path)
+        return local_path
@@ -9,6 +9,9 @@ from socket import gethostname
 from tokenizers import Tokenizer
 from statistics import mean
 import fnmatch
+import math
+import random
+import time
 
 import torch
 import torch.nn as nn
@@ -19,8 +22,9 @@ from torch.nn.parallel import DistributedDataParallel
 from lamb import Lamb
 from config import BertConfig
 from model import Bert
-from utils import cosine_schedule_with_warmup_cooldown, is_main_process, get_rank, seed_everything, get_world_size
-from dataset import Dataset, ValidationDataset, apply_mask
+from utils import cosine_schedule_with_warmup_cooldown, is_main_process, get_rank, seed_everything, get_world_size, read_shard_stats, write_stage_record, read_expected_shards, is_shard_ready
+from dataset import Dataset, ValidationDataset, StreamingDataset, DatasetPrefetcher, EpochBatchSampler, EpochDataset, SpanMaskingStrategy, RandomBatchSampler, TokenBudgetBatchSampler, apply_mask, seed_worker
+from staging import ShardStager
 
 
 if int(os.environ["SLURM_PROCID"]) == 0:
@@ -52,18 +56,33 @@ def parse_arguments():
     parser.add_argument("--mask_random_p", default=0.1, type=float, help="Masking probability.")
     parser.add_argument("--mask_keep_p", default=0.1, type=float, help="Masking probability.")
     parser.add_argument("--short_p", default=0.1, type=float, help="Short sequence probability.")
+    parser.add_argument('--validation_cache', type=str, default="device", choices=["device", "pinned"], help="Keep the masked validation batches on the GPU, or in pinned CPU memory if they don't fit")
+    parser.add_argument('--streaming', default=False, action=argparse.BooleanOptionalAction, help="Train on one continuous stream of batches over all shards of every rank instead of one shard per epoch")
+    parser.add_argument('--shuffle_buffer_size', type=int, default=65536, help='Number of segments in the shuffle buffer of --streaming')
+    parser.add_argument('--dynamic_batching', default=False, action=argparse.BooleanOptionalAction, help="Group the training samples by length and fill every batch up to batch_size x seq_length subwords instead of using a fixed batch size (not used with --packing)")
+    parser.add_argument('--n_length_buckets', type=int, default=8, help='Number of length buckets for --dynamic_batching')
+    parser.add_argument('--packing', default=False, action=argparse.BooleanOptionalAction, help="Pack several segments into every training sequence, with attention only within each segment (short_p isn't used then)")
     parser.add_argument("--weight_decay", default=0.1, type=float, help="Short sequence probability.")
     parser.add_argument("--optimizer_eps", default=1e-6, type=float, help="Optimizer epsilon.")
     parser.add_argument("--optimizer_beta1", default=0.9, type=float, help="Optimizer beta1.")
     parser.add_argument("--optimizer_beta2", default=0.98, type=float, help="Optimizer beta2.")
     parser.add_argument("--max_gradient", default=2.0, type=float, help="Max value for gradient clipping.")
     parser.add_argument('--mixed_precision', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--shard_timeout', type=int, default=6 * 3600, help='How long to wait (in seconds) for a shard that is still being tokenized')
+    parser.add_argument('--shard_poll_interval', type=int, default=60, help='How often to check (in seconds) whether a missing shard is ready')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of DataLoader workers preparing the batches of every rank')
+    parser.add_argument('--worker_start_method', type=str, default="spawn", choices=["spawn", "forkserver", "fork"], help='How the DataLoader workers are started, forking a process with an initialized GPU context is not safe everywhere')
+    parser.add_argument('--staging_dir', type=str, default=None, help='Copy the upcoming training shards of every rank here in the background (e.g. /flash/project_465000498/staging)')
+    parser.add_argument('--staging_ahead', type=int, default=2, help='Number of upcoming epochs staged ahead of their use')
+    parser.add_argument('--stage_record', type=str, default=None, help='Written by schedule.py jobs after the training finishes')
+    parser.add_argument('--stage_key', type=str, default=None, help='Fingerprint of the training data and arguments, stored in the stage record')
     args = parser.parse_args()
 
     args.input_dir = args.input_dir.format(language=args.language)
     args.name = args.name.format(language=args.language)
     args.tokenizer_path = f"{args.input_dir}/tokenizer.json"
     args.output_dir = f"{args.output_dir}/{args.name}"
+    args.stream_position = 0  # the newest shard of --streaming, restored from checkpoints
 
     return args
 
@@ -114,7 +133,13 @@ def setup_training(args, tokenizer):
     if is_main_process():
         os.system(f"mkdir -p {args.output_dir}")
 
-    args.n_training_files = len(fnmatch.filter(os.listdir(f"{args.input_dir}/tokenized_shards"), "train_*.pt.gz"))
+    # the training can start while the shards are still being tokenized, then only shards.json knows how many there will be
+    if read_expected_shards(f"{args.input_dir}/tokenized_shards") is not None:
+        args.n_training_files = read_expected_shards(f"{args.input_dir}/tokenized_shards")
+    else:
+        # older runs without shards.json, possibly also without the .stats.json sidecars
+        filenames = os.listdir(f"{args.input_dir}/tokenized_shards")
+        args.n_training_files = len(fnmatch.filter(filenames, "train_*.stats.json")) or len(fnmatch.filter(filenames, "train_*.pt.gz"))
     args.n_training_files = 2 ** (args.n_training_files - 1).bit_length()
 
     if is_main_process():
@@ -122,6 +147,20 @@ def setup_training(args, tokenizer):
         print(f"In total, the model will be trained on 'steps'({args.max_steps:,}) x 'GPUs'({get_world_size()}) x 'batch_size'({args.batch_size:,}) x 'seq_len'({args.seq_length:,}) = {args.max_steps * get_world_size() * args.batch_size * args.seq_length:,} subword instances")
         print(f"Found {args.n_training_files} training shards", flush=True)
 
+        # only for this report, the other ranks don't read the sidecars
+        shard_stats = read_shard_stats(f"{args.input_dir}/tokenized_shards")
+        if len(shard_stats) > 0:
+            n_subwords = sum(stats["n_subwords"] for stats in shard_stats.values())
+            n_segments = sum(stats["n_segments"][str(args.seq_length)] for stats in shard_stats.values())
+            min_segments = min(stats["n_segments"][str(args.seq_length)] for stats in shard_stats.values())
+
+            # every epoch trains each GPU on half of the (half-overlapping) segments of one shard, see min_length in load_datasets
+            steps_per_epoch = min_segments // args.batch_size // 2
+            n_epochs = math.ceil(args.max_steps / max(1, steps_per_epoch))
+            n_passes = n_epochs * get_world_size() / len(shard_stats)
+            print(f"The training shards contain {n_subwords:,} subwords in {n_segments:,} segments of length {args.seq_length}")
+            print(f"Expecting at most {steps_per_epoch:,} steps per epoch, {n_epochs:,} epochs in total, that is about {n_passes:.2f} passes over the training data", flush=True)
+
     args.mask_token_id = tokenizer.token_to_id("[MASK]")
     args.cls_token_id = tokenizer.token_to_id("[CLS]")
     args.pad_token_id = tokenizer.token_to_id("[PAD]")
@@ -218,7 +257,17 @@ def prepare_model_and_optimizer(args, device, local_rank, checkpoint):
     return model, config, optimizer, scheduler
 
 
-def training_epoch(model, train_dataloader, valid_dataloader, optimizer, scheduler, global_step, epoch, args, device, max_local_steps):
+def is_end_of_epoch(global_step, local_step, max_local_steps, args):
+    # an epoch ends at max_steps, after max_local_steps batches, and when the training phase (sequence length) changes
+    return (
+        global_step >= args.max_steps
+        or local_step >= max_local_steps - 1
+        or global_step == (args.max_steps // 10 * 7)
+        or global_step == (args.max_steps // 10 * 9)
+    )
+
+
+def training_epoch(model, train_dataloader, valid_batches, masking_strategy, optimizer, scheduler, global_step, epoch, shard_offset, args, device, max_local_steps):
     model = model.train()
     optimizer.zero_grad(set_to_none=True)
 
@@ -227,13 +276,23 @@ def training_epoch(model, train_dataloader, valid_dataloader, optimizer, schedul
     else:
         train_iter = train_dataloader
 
-    for local_step, batch in enumerate(train_iter):
-        input_ids, attention_mask, mask_ratios, replacement_tokens = [t.to(device, non_blocking=True) for t in batch]
-        input_ids, mask_ratios, replacement_tokens = input_ids.t(), mask_ratios.t(), replacement_tokens.t()
+    # an epoch resumed from a checkpoint starts at the batch after it
+    first_step = getattr(train_dataloader.sampler, "start_batch", 0)
+    for local_step, batch in enumerate(train_iter, start=first_step):
+        if args.streaming:
+            # the newest stream position, a restarted stream continues from there
+            *batch, stream_position = batch
+            args.stream_position = stream_position.item()
+
+        # packed batches come with the segment ids of every subword
+        input_ids, attention_mask, *segment_ids = [t.to(device, non_blocking=True) for t in batch]
+        segment_ids = segment_ids[0] if len(segment_ids) > 0 else None
+        input_ids = input_ids.t()
+        mask_ratios, replacement_tokens = masking_strategy(input_ids)
         input_ids, target_ids, mask_p = apply_mask(args, input_ids, mask_ratios, replacement_tokens, global_step)
 
         with torch.cuda.amp.autocast(args.mixed_precision, dtype=torch.bfloat16):
-            loss, perplexity, accuracy = model(input_ids, attention_mask, target_ids)
+            loss, perplexity, accuracy = model(input_ids, attention_mask, target_ids, segment_ids)
 
         loss.backward()
         grad_norm = nn.utils.clip_grad_norm_(model.parameters(), args.max_gradient)
@@ -244,9 +303,10 @@ def training_epoch(model, train_dataloader, valid_dataloader, optimizer, schedul
         global_step += 1
 
         with torch.no_grad():
-            metrics = torch.stack([loss, perplexity, accuracy])
+            padding_fraction = attention_mask.float().mean()
+            metrics = torch.stack([loss, perplexity, accuracy, padding_fraction])
             torch.distributed.all_reduce(metrics, torch.distributed.ReduceOp.AVG)
-            loss, perplexity, accuracy = metrics.tolist()
+            loss, perplexity, accuracy, padding_fraction = metrics.tolist()
 
         if is_main_process():
             train_iter.set_postfix_str(f"loss: {loss:.2f}, accuracy: {accuracy * 100.0:.2f}, grad_norm: {grad_norm:.2f}, lr: {optimizer.param_groups[0]['lr']:.5f}")
@@ -264,6 +324,7 @@ def training_epoch(model, train_dataloader, valid_dataloader, optimizer, schedul
                     "stats/grad_norm": grad_norm,
                     "stats/seq_length": args.seq_length,
                     "stats/mask_p": mask_p,
+                    "stats/padding_fraction": padding_fraction,
                 },
                 commit=False
             )
@@ -271,8 +332,9 @@ def training_epoch(model, train_dataloader, valid_dataloader, optimizer, schedul
         optimizer.zero_grad(set_to_none=True)
 
         if global_step % args.save_every == 0:
-            save(model, optimizer, scheduler, global_step, epoch, args)
-            validation_epoch(model, valid_dataloader, epoch, args, device)
+            next_batch = None if args.streaming or is_end_of_epoch(global_step, local_step, max_local_steps, args) else local_step + 1
+            save(model, optimizer, scheduler, global_step, epoch, args, gather_data_states(epoch, next_batch, shard_offset, args))
+            validation_epoch(model, valid_batches, epoch, args, device)
             model = model.train()
 
         if is_main_process():
@@ -280,28 +342,25 @@ def training_epoch(model, train_dataloader, valid_dataloader, optimizer, schedul
 
 
         # Exiting the training due to hitting max steps
-        if global_step >= args.max_steps or local_step >= max_local_steps - 1:
-            return global_step
-        if global_step == (args.max_steps // 10 * 7) or global_step == (args.max_steps // 10 * 9):
+        if is_end_of_epoch(global_step, local_step, max_local_steps, args):
             return global_step
 
     return global_step
 
 
 @torch.no_grad()
-def validation_epoch(model, valid_dataloader, epoch, args, device):
+def validation_epoch(model, valid_batches, epoch, args, device):
     model = model.eval()
 
     if is_main_process():
-        valid_iter = tqdm(valid_dataloader, desc="Validation iteration")
+        valid_iter = tqdm(valid_batches, desc="Validation iteration")
     else:
-        valid_iter = valid_dataloader
+        valid_iter = valid_batches
 
     losses, perplexities, accuracies = [], [], []
     for batch in valid_iter:
-        input_ids, attention_mask, mask_ratios, replacement_tokens = [t.to(device, non_blocking=True) for t in batch]
-        input_ids, mask_ratios, replacement_tokens = input_ids.t(), mask_ratios.t(), replacement_tokens.t()
-        input_ids, target_ids, _ = apply_mask(args, input_ids, mask_ratios, replacement_tokens, args.max_steps)
+        # already masked, and already on the device unless --validation_cache is pinned
+        input_ids, attention_mask, target_ids = [t.to(device, non_blocking=True) for t in batch]
 
         with torch.cuda.amp.autocast(args.mixed_precision, dtype=torch.bfloat16):
             loss, perplexity, accuracy = model(input_ids, attention_mask, target_ids)
@@ -326,7 +385,44 @@ def validation_epoch(model, valid_dataloader, epoch, args, device):
         )
 
 
-def save(model, optimizer, scheduler, global_step, epoch, args):
+def gather_data_states(epoch, next_batch, shard_offset, args):
+    # where every rank is in its training data and the state of its random generators, collected by the main process;
+    # next_batch is None when the epoch is over, a resumed run then starts with the next epoch
+    state = {
+        "epoch": epoch,
+        "next_batch": next_batch,
+        "shard_offset": shard_offset,
+        "stream_position": args.stream_position,
+        "torch_rng_state": torch.get_rng_state(),
+        "cuda_rng_state": torch.cuda.get_rng_state(),
+        "python_rng_state": random.getstate(),
+    }
+    states = [None] * get_world_size()
+    torch.distributed.all_gather_object(states, state)
+    return states
+
+
+def restore_data_state(checkpoint, args):
+    # returns (epoch, first batch of that epoch, shard_offset) to continue exactly where the checkpoint was saved,
+    # checkpoints without the data states (or from a different number of GPUs) continue with the next epoch
+    data_states = checkpoint.get("data_states")
+    if data_states is None or len(data_states) != get_world_size():
+        if is_main_process():
+            print("WARNING: the checkpoint has no data state for this number of GPUs, continuing with the next epoch", flush=True)
+        return checkpoint["epoch"] + 1, 0, 0
+
+    state = data_states[get_rank()]
+    args.stream_position = state["stream_position"]
+    torch.set_rng_state(state["torch_rng_state"])
+    torch.cuda.set_rng_state(state["cuda_rng_state"])
+    random.setstate(state["python_rng_state"])
+
+    if state["next_batch"] is None:
+        return state["epoch"] + 1, 0, state["shard_offset"]
+    return state["epoch"], state["next_batch"], state["shard_offset"]
+
+
+def save(model, optimizer, scheduler, global_step, epoch, args, data_states=None):
     checkpoint_path = f"{args.output_dir}/model_step_{global_step}.bin"
     if is_main_process():
         model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model itself
@@ -338,74 +434,209 @@ def save(model, optimizer, scheduler, global_step, epoch, args):
                 "global_step": global_step,
                 "epoch": epoch,
                 "args": args,
+                "data_states": data_states,
             },
             checkpoint_path
         )
+    return checkpoint_path
 
 
-def load_datasets(args, tokenizer, epoch, global_step, device, train_data, valid_data, shard_offset):
+def wait_for_shard(path, is_expected, args, device):
+    # all ranks poll together (with the same number of polls), so that nobody waits for the others inside a collective;
+    # only shards announced by shards.json are waited for
+    for i in range(args.shard_timeout // args.shard_poll_interval + 1):
+        is_ready = torch.tensor(int(is_shard_ready(path) or not is_expected), dtype=torch.long, device=device)
+        torch.distributed.all_reduce(is_ready, torch.distributed.ReduceOp.MIN)
+        if is_ready.item() == 1:
+            return True
 
-    for i in range(8):
-        train_index = (get_rank() + epoch * get_world_size() + shard_offset) % args.n_training_files
-        train_path = f"{args.input_dir}/tokenized_shards/train_{train_index:05d}.pt.gz"
+        if i == 0 and is_main_process():
+            print(f"Waiting for the shards of the next epoch to be tokenized (up to {args.shard_timeout} s)", flush=True)
+        time.sleep(args.shard_poll_interval)
 
-        if not os.path.exists(train_path):
-            if args.n_training_files <= get_world_size():
-                shard_offset += torch.randint(0, args.n_training_files, (1,)).item()
-            else:
-                shard_offset += get_world_size()
-            print(f"WARNING: Training shard {train_path} does not exist. Trying {train_index + get_world_size()} instead.")
-        else:
-            break
-    else:
-        print(f"ERROR: None of the shards exist. Exiting.")
-        exit(1)
+    return is_shard_ready(path)
+
+
+def load_train_data(train_path, tokenizer, args, stager=None, is_prefetch=False):
+    # the prefetch of the next epoch waits for its staged copy and reads its tokens ahead of their use
+    load_path = stager.get(train_path, wait=is_prefetch) if stager is not None else train_path
+    train_data = Dataset(load_path, tokenizer, args)
+    if is_prefetch:
+        train_data.read_tokens()
+    train_data.path = train_path  # identifies the shard, not the place it was read from
+    train_data.staged_path = load_path if load_path != train_path else None
+    return train_data
 
-    train_seed = args.seed + get_rank() + epoch * get_world_size()
 
+def set_training_phase(args, global_step):
+    # sets the sequence length of the current phase and returns its batch size
     if (global_step + 1) / args.max_steps >= 0.9:
         args.seq_length = 512
-        batch_size = args.batch_size // 4
+        return args.batch_size // 4
     elif (global_step + 1) / args.max_steps >= 0.7:
         args.seq_length = 256
-        batch_size = args.batch_size // 2
+        return args.batch_size // 2
     else:
         args.seq_length = 128
-        batch_size = args.batch_size
+        return args.batch_size
 
-    if train_data is None or train_data.path != train_path or train_data.seq_length != args.seq_length:
-        train_data = Dataset(train_path, tokenizer, args)
-        print(f"Loaded training file {train_index} on GPU {get_rank()}", flush=True)
-        if is_main_process():
-            train_data.show_random_item(tokenizer)
 
+def load_validation(args, tokenizer, valid_data, masking_strategy, device):
+    # the validation batches are built and masked only once, then reused by every validation_epoch
     if valid_data is None:
+        start_time = time.time()
         valid_data = ValidationDataset(f"{args.input_dir}/tokenized_shards/validation.pt.gz", tokenizer, int(os.environ["SLURM_PROCID"]), int(os.environ["WORLD_SIZE"]), args)
+        valid_data.masked_batches(masking_strategy, args, device, pin_memory=args.validation_cache == "pinned")
+        if is_main_process():
+            print(f"Prepared {len(valid_data.batches)} masked validation batches per GPU in {time.time() - start_time:.1f} s", flush=True)
 
-    min_length = torch.tensor(len(train_data) // batch_size // 2, dtype=torch.long, device=device)
-    torch.distributed.all_reduce(min_length, torch.distributed.ReduceOp.MIN)
+    return valid_data, valid_data.batches
+
+
+def load_stream(args, tokenizer, masking_strategy, epoch, global_step, device, valid_data, shard_offset):
+    # one continuous stream instead of one shard per epoch, it's only restarted (from the newest shard it reached)
+    # when the sequence length changes; every rank always has a next batch, so nothing is truncated to keep them in lockstep
+    if valid_data is None:
+        wait_for_shard(f"{args.input_dir}/tokenized_shards/validation.pt.gz", read_expected_shards(f"{args.input_dir}/tokenized_shards") is not None, args, device)
+
+    batch_size = set_training_phase(args, global_step)
+    train_seed = args.seed + get_rank() + epoch * get_world_size()
+
+    train_data = StreamingDataset(
+        tokenizer, argparse.Namespace(**vars(args)), get_rank(), get_world_size(), shard_offset,
+        args.stream_position, batch_size, train_seed, args.shuffle_buffer_size
+    )
 
+    # the shards of the stream are waited for here, by all ranks together, the DataLoader workers only skip the
+    # ones that are not ready; every rank has the same number of positions in a cycle, so the collectives match
+    n_expected_shards = read_expected_shards(f"{args.input_dir}/tokenized_shards")
+    ready_shards = []
+    for position in train_data.cycle_positions():
+        train_path, train_index = train_data.shard_path(position)
+        is_expected = n_expected_shards is not None and train_index < n_expected_shards
+        if wait_for_shard(train_path, is_expected, args, device) and is_shard_ready(train_path):
+            ready_shards.append(train_index)
+    train_data.set_ready_shards(ready_shards)
     train_dataloader = DataLoader(
         train_data,
-        shuffle=True,
-        batch_size=batch_size,
-        num_workers=0,  # non-zero num_workers cause segmenation fault
-        generator=torch.Generator().manual_seed(train_seed),
-        drop_last=True,
+        batch_size=None,
+        num_workers=args.num_workers,
+        multiprocessing_context=args.worker_start_method if args.num_workers > 0 else None,
+        worker_init_fn=seed_worker,
+        generator=torch.Generator().manual_seed(train_seed),  # the base seed of the workers
         pin_memory=True,
     )
+    if is_main_process():
+        print(f"Streaming the training shards from stream position {args.stream_position} with sequence length {args.seq_length}", flush=True)
+
+    valid_data, valid_batches = load_validation(args, tokenizer, valid_data, masking_strategy, device)
+    return train_data, valid_data, train_dataloader, valid_batches, math.inf, shard_offset
 
-    valid_dataloader = DataLoader(
-        valid_data,
-        shuffle=False,
-        batch_size=256,
-        num_workers=0,  # non-zero num_workers cause segmenation fault
-        generator=torch.Generator().manual_seed(42),
-        drop_last=True,
-        pin_memory=True,
-    )
 
-    return train_data, valid_data, train_dataloader, valid_dataloader, min_length, shard_offset
+def load_datasets(args, tokenizer, masking_strategy, epoch, global_step, device, train_data, valid_data, shard_offset, stager=None, prefetcher=None, start_batch=0, train_dataloader=None):
+    if args.streaming:
+        return load_stream(args, tokenizer, masking_strategy, epoch, global_step, device, valid_data, shard_offset)
+
+    # the shards might still be tokenized, wait for them before falling back to other shards
+    n_expected_shards = read_expected_shards(f"{args.input_dir}/tokenized_shards")
+    train_index = (get_rank() + epoch * get_world_size() + shard_offset) % args.n_training_files
+    is_expected = n_expected_shards is not None and train_index < n_expected_shards
+    wait_for_shard(f"{args.input_dir}/tokenized_shards/train_{train_index:05d}.pt.gz", is_expected, args, device)
+    if valid_data is None:
+        wait_for_shard(f"{args.input_dir}/tokenized_shards/validation.pt.gz", n_expected_shards is not None, args, device)
+
+    for i in range(8):
+        train_index = (get_rank() + epoch * get_world_size() + shard_offset) % args.n_training_files
+        train_path = f"{args.input_dir}/tokenized_shards/train_{train_index:05d}.pt.gz"
+
+        if not is_shard_ready(train_path):
+            if args.n_training_files <= get_world_size():
+                shard_offset += torch.randint(0, args.n_training_files, (1,)).item()
+            else:
+                shard_offset += get_world_size()
+            print(f"WARNING: Training shard {train_path} is not ready. Trying {train_index + get_world_size()} instead.")
+        else:
+            break
+    else:
+        print(f"ERROR: None of the shards exist. Exiting.")
+        exit(1)
+
+    train_seed = args.seed + get_rank() + epoch * get_world_size()
+    batch_size = set_training_phase(args, global_step)
+
+    if train_data is None or train_data.path != train_path:
+        if stager is not None and train_data is not None:
+            stager.release(train_data.path)
+
+        # usually already loaded in the background during the previous epoch
+        prefetched_data = prefetcher.get(train_path) if prefetcher is not None else None
+        train_data = prefetched_data if prefetched_data is not None else load_train_data(train_path, tokenizer, args, stager)
+        train_data.set_seq_length(args.seq_length)
+        print(
+            f"{'Prefetched' if prefetched_data is not None else 'Loaded'} training file {train_index} on GPU {get_rank()}"
+            + (f" from {train_data.staged_path}" if train_data.staged_path is not None else "")
+            + f" in {train_data.load_time:.1f} s, {len(train_data)} segments, {train_data.memory_overhead():.2f} bytes of index per token",
+            flush=True
+        )
+        if is_main_process():
+            train_data.show_random_item(tokenizer, masking_strategy)
+    elif train_data.seq_length != args.seq_length:
+        # the same shard in the next training phase, only its segments are recomputed from the document offsets
+        start_time = time.time()
+        train_data.set_seq_length(args.seq_length)
+        print(f"Resegmented training file {train_index} on GPU {get_rank()} to sequence length {args.seq_length} in {time.time() - start_time:.2f} s, {len(train_data)} segments", flush=True)
+
+    # copy the shards of the next epochs to the fast storage while training on this one
+    if stager is not None:
+        stager.prefetch([
+            f"{args.input_dir}/tokenized_shards/train_{(get_rank() + next_epoch * get_world_size() + shard_offset) % args.n_training_files:05d}.pt.gz"
+            for next_epoch in range(epoch + 1, epoch + 1 + args.staging_ahead)
+        ])
+
+    # load the shard of the next epoch in the background, from its staged copy once it's there
+    next_index = (get_rank() + (epoch + 1) * get_world_size() + shard_offset) % args.n_training_files
+    next_path = f"{args.input_dir}/tokenized_shards/train_{next_index:05d}.pt.gz"
+    if prefetcher is not None and next_path != train_path and is_shard_ready(next_path):
+        next_args = argparse.Namespace(**vars(args))
+        prefetcher.prefetch(next_path, lambda: load_train_data(next_path, tokenizer, next_args, stager, is_prefetch=True))
+
+    # the sampler yields (seed, list of indices) pairs, the dataset builds each batch at once (see Dataset.get_batch)
+    if args.dynamic_batching and not args.packing:
+        # the same number of subwords per step as the fixed batches of this phase, so max_steps keeps its meaning
+        train_sampler = TokenBudgetBatchSampler(
+            len(train_data), args.seq_length, args.short_p, batch_size * args.seq_length,
+            torch.Generator().manual_seed(train_seed), args.n_length_buckets
+        )
+    else:
+        train_sampler = RandomBatchSampler(len(train_data), batch_size, torch.Generator().manual_seed(train_seed))
+
+    # the number of batches differs between the ranks with dynamic batching, all of them stop after the same number of steps
+    min_length = torch.tensor(len(train_sampler) // 2, dtype=torch.long, device=device)
+    torch.distributed.all_reduce(min_length, torch.distributed.ReduceOp.MIN)
+
+    # a resumed epoch skips the batches trained before the checkpoint, without building them
+    train_sampler.start_batch = start_batch
+    if start_batch > 0:
+        print(f"Resuming training file {train_index} on GPU {get_rank()} at batch {start_batch}", flush=True)
+
+    # one DataLoader with persistent workers for the whole training, only its sampler is replaced every epoch;
+    # the workers open the shard of the epoch themselves (from its staged copy if there is one)
+    if train_dataloader is None:
+        train_dataloader = DataLoader(
+            EpochDataset(tokenizer, argparse.Namespace(**vars(args))),
+            sampler=EpochBatchSampler(),
+            batch_size=None,
+            num_workers=args.num_workers,
+            multiprocessing_context=args.worker_start_method if args.num_workers > 0 else None,
+            worker_init_fn=seed_worker,
+            generator=torch.Generator().manual_seed(train_seed),  # the base seed of the workers
+            pin_memory=True,
+            persistent_workers=args.num_workers > 0,
+        )
+    train_dataloader.sampler.set_epoch(train_sampler, train_data.staged_path or train_data.path, args.seq_length)
+
+    valid_data, valid_batches = load_validation(args, tokenizer, valid_data, masking_strategy, device)
+    return train_data, valid_data, train_dataloader, valid_batches, min_length, shard_offset
 
 
 if __name__ == "__main__":
@@ -424,14 +655,37 @@ if __name__ == "__main__":
     tokenizer = Tokenizer.from_file(args.tokenizer_path)
     device, local_rank = setup_training(args, tokenizer)
     model, config, optimizer, scheduler = prepare_model_and_optimizer(args, device, local_rank, checkpoint)
-    train_data, valid_data, shard_offset = None, None, 0
+    train_data, valid_data, train_dataloader, shard_offset, start_batch = None, None, None, 0, 0
+    if checkpoint is not None:
+        initial_epoch, start_batch, shard_offset = restore_data_state(checkpoint, args)
+    start_time, initial_step = time.time(), global_step
+
+    # the masking runs batched on the GPU, after the batches are transferred
+    masking_strategy = SpanMaskingStrategy(args.n_special_tokens, args.mask_random_p, args.mask_keep_p, args.vocab_size, args.mask_token_id)
+
+    prefetcher = DatasetPrefetcher()
+    stager = None
+    if args.staging_dir is not None:
+        stager = ShardStager(os.path.join(args.staging_dir, os.environ.get("SLURM_JOB_ID", "local"), f"rank_{get_rank()}"))
 
     for epoch in count(initial_epoch):
-        train_data, valid_data, train_dataloader, valid_dataloader, min_length, shard_offset = load_datasets(args, tokenizer, epoch, global_step, device, train_data, valid_data, shard_offset)
-        global_step = training_epoch(model, train_dataloader, valid_dataloader, optimizer, scheduler, global_step, epoch, args, device, min_length)
+        train_data, valid_data, train_dataloader, valid_batches, min_length, shard_offset = load_datasets(args, tokenizer, masking_strategy, epoch, global_step, device, train_data, valid_data, shard_offset, stager, prefetcher, start_batch, train_dataloader)
+        global_step = training_epoch(model, train_dataloader, valid_batches, masking_strategy, optimizer, scheduler, global_step, epoch, shard_offset, args, device, min_length)
+        start_batch = 0
 
         if global_step >= args.max_steps:
             break
 
-    save(model, optimizer, scheduler, global_step, epoch, args)
-    validation_epoch(model, valid_dataloader, epoch, args, device)
+    checkpoint_path = save(model, optimizer, scheduler, global_step, epoch, args, gather_data_states(epoch, None, shard_offset, args))
+    validation_epoch(model, valid_batches, epoch, args, device)
+
+    if is_main_process():
+        throughput = {
+            "stage": "train",
+            "seconds": time.time() - start_time,
+            "steps": global_step - initial_step,
+            "n_gpus": get_world_size(),
+            "batch_size": args.batch_size,
+            "config": os.path.basename(args.config_file),
+        }
+        write_stage_record(args.stage_record, args.stage_key, [checkpoint_path], throughput)
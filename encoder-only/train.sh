@@ -40,10 +40,12 @@ SING_BIND="/scratch/project_465000498,/flash/project_465000498"
 set -euo pipefail
 
 LANGUAGE=${1}
+EXTRA_ARGS=${@:2}
 
 CMD=" \
     /scratch/project_465000498/HPLT-WP4/encoder-only/train.py \
     --language $LANGUAGE \
+    $EXTRA_ARGS \
 "
 
 # Bind masks from Samuel Antao
@@ -1,9 +1,16 @@
 import torch
 import torch.distributed as dist
 import os
+import sys
 import random
 import math
 
+# the layout of the tokenized shards and their sidecars, and the stage records of schedule.py, are defined only once,
+# in preprocessing/shard_stats.py and preprocessing/manifest.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from shard_stats import flat_paths, read_shard_stats
+from manifest import manifest_path, read_json, write_stage_record
+
 
 def cosine_schedule_with_warmup(optimizer, num_warmup_steps: int, num_training_steps: int, min_factor: float):
     def lr_lambda(current_step):
@@ -79,3 +86,28 @@ def get_world_size():
 
 def is_main_process():
     return get_rank() == 0
+
+
+def read_shard_plan(tokenized_dir):
+    # shards.json is written by schedule.py before the tokenization starts, None for older runs without it
+    return read_json(os.path.join(tokenized_dir, "shards.json"))
+
+
+def read_expected_shards(tokenized_dir):
+    shard_plan = read_shard_plan(tokenized_dir)
+    return shard_plan["n_shards"] if shard_plan is not None else None
+
+
+def is_shard_ready(path):
+    # preprocessing/tokenize_shards.py writes the manifest after the flat arrays and the sidecars, so it marks a finished
+    # shard, but only if it was tokenized with the tokenizer of shards.json (unknown while the tokenizer is retrained,
+    # then schedule.py removed the manifests of all shards anyway); older runs without shards.json have no manifests,
+    # there an existing .pt.gz shard is a finished one
+    shard_plan = read_shard_plan(os.path.dirname(path))
+    if shard_plan is None:
+        return os.path.exists(path) or os.path.exists(manifest_path(path))
+
+    manifest = read_json(manifest_path(path))
+    if manifest is None:
+        return False
+    return shard_plan.get("tokenizer_sha256") is None or manifest["tokenizer_sha256"] == shard_plan["tokenizer_sha256"]
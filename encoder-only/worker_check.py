@@ -0,0 +1,53 @@
+# regression check for the segmentation faults of forked DataLoader workers (the reason for the old num_workers=0):
+# the workers run in a fresh process that is set up like a training rank before its first epoch, once forked (the old
+# setup, expected to crash on the GPU nodes) and once with the start method of the training; used by
+# benchmark_dataset.py --check_worker_crash
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+import torch
+
+
+# exit statuses of the check
+REPRODUCED = 0  # the forked workers crash and the others don't
+WORKERS_CRASH = 1  # the workers of the training's start method crash (or fail)
+NOT_REPRODUCED = 2  # neither crashes, the check can't tell whether the start method matters here
+
+
+def initialize_like_training():
+    # the state of a training rank when its DataLoader starts: the GPU runtime is initialized and in use, and the
+    # staging and prefetching threads are running
+    if torch.cuda.is_available():
+        torch.cuda.set_device(0)
+        torch.ones(1, device="cuda").sum().item()
+    stop = threading.Event()
+    threading.Thread(target=stop.wait, daemon=True).start()
+    return stop
+
+
+def run_child(script, arguments):
+    # returns the exit code of the child process, negative if it was killed by a signal (-11 for a segfault)
+    return subprocess.run([sys.executable, os.path.abspath(script), *arguments]).returncode
+
+
+def describe_exit(returncode):
+    if returncode == 0:
+        return "ok"
+    if returncode < 0:
+        return f"crashed ({signal.Signals(-returncode).name})"
+    return f"failed (exit code {returncode})"
+
+
+def check_outcome(fork_returncode, returncode, start_method):
+    # returns (exit status, message) of the check from the exit codes of the forked and the other child
+    if returncode != 0:
+        return WORKERS_CRASH, f"FAILED: the {start_method} workers {describe_exit(returncode)}"
+    if fork_returncode < 0:
+        return REPRODUCED, f"REPRODUCED: the forked workers {describe_exit(fork_returncode)}, the {start_method} workers don't"
+    if fork_returncode != 0:
+        return NOT_REPRODUCED, f"NOT REPRODUCED: the forked workers {describe_exit(fork_returncode)} without crashing"
+    return NOT_REPRODUCED, f"NOT REPRODUCED: the forked workers don't crash here (GPU available: {torch.cuda.is_available()})"
@@ -0,0 +1,234 @@
+# executors used by schedule.py to run the jobs of the pipeline (shard, train tokenizer, tokenize, train)
+# SlurmExecutor submits every job with sbatch and chains them with --dependency=afterok,
+# LocalExecutor runs the same job graph on the current machine with a pool of processes
+#
+# a job graph saved with LocalExecutor.save() can be run inside a SLURM allocation by: python3 executors.py plan.json
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+
+class Job:
+    def __init__(self, name, chdir, slurm_script, slurm_args, python_args, dependencies=(), n_tasks=1, cpus_per_task=1, n_gpus=0, log_name=None, sbatch_args=(), cost=0.0):
+        self.name = name
+        self.chdir = chdir  # relative to the repository root
+        self.slurm_script = slurm_script  # the sbatch script with its positional arguments
+        self.slurm_args = [str(arg) for arg in slurm_args]
+        self.python_args = [str(arg) for arg in python_args]  # the python script with its arguments, used by the local executor
+        self.dependencies = list(dependencies)
+        self.n_tasks = n_tasks  # number of ranks, every rank gets its SLURM_PROCID like under srun
+        self.cpus_per_task = cpus_per_task
+        self.n_gpus = n_gpus
+        self.log_name = log_name or name.lower()
+        self.sbatch_args = [str(arg) for arg in sbatch_args]  # additional sbatch options, e.g. the size of the allocation
+        self.cost = cost  # estimated core-hours
+        self.id = None
+
+    def __repr__(self):
+        return f"Job({self.name}, id={self.id})"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "chdir": os.path.abspath(self.chdir),
+            "slurm_script": self.slurm_script,
+            "slurm_args": self.slurm_args,
+            "python_args": self.python_args,
+            "dependencies": [dependency.id for dependency in self.dependencies],
+            "n_tasks": self.n_tasks,
+            "cpus_per_task": self.cpus_per_task,
+            "n_gpus": self.n_gpus,
+            "log_name": self.log_name,
+            "cost": self.cost,
+        }
+
+    @classmethod
+    def from_dict(cls, content, jobs_by_id):
+        job = cls(
+            content["name"], content["chdir"], content["slurm_script"], content["slurm_args"], content["python_args"],
+            dependencies=[jobs_by_id[dependency_id] for dependency_id in content["dependencies"]],
+            n_tasks=content["n_tasks"], cpus_per_task=content["cpus_per_task"], n_gpus=content["n_gpus"],
+            log_name=content["log_name"], cost=content["cost"]
+        )
+        job.id = content["id"]
+        return job
+
+
+class SlurmExecutor:
+    def __init__(self, log_dir="logs"):
+        self.log_dir = log_dir  # relative to the working directory of the job
+
+    def submit(self, job):
+        command = f"sbatch --job-name {job.name} --chdir {job.chdir} --output {self.log_dir}/{job.log_name}-%j.out"
+        if len(job.sbatch_args) > 0:
+            command += f" {' '.join(job.sbatch_args)}"
+        dependency_ids = [dependency.id for dependency in job.dependencies if dependency.id is not None]
+        if len(dependency_ids) > 0:
+            command += f" --dependency=afterok:{':'.join(dependency_ids)}"
+        command += f" {job.slurm_script} {' '.join(job.slurm_args)}"
+
+        bash_output = subprocess.check_output(command, shell=True).decode("utf-8")
+        print(bash_output, flush=True)
+        job.id = bash_output.split()[-1]
+        return job.id
+
+    def run(self):
+        # nothing to wait for, SLURM takes care of the rest
+        return True
+
+
+class LocalExecutor:
+    def __init__(self, n_cores=None, n_gpus=0, log_dir="logs", poll_interval=1.0, status_path=None):
+        self.n_cores = n_cores or os.cpu_count()
+        self.n_gpus = n_gpus
+        self.log_dir = os.path.abspath(log_dir)
+        self.poll_interval = poll_interval
+        self.status_path = status_path  # optional JSON file with the state of every job, rewritten on every change
+        self.jobs = []
+        self.status = {}
+        os.makedirs(self.log_dir, exist_ok=True)
+
+    def log_path(self, job):
+        return os.path.join(self.log_dir, f"{job.log_name}-local{job.id}.out")
+
+    def total_cost(self):
+        return sum(job.cost for job in self.jobs)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump([job.to_dict() for job in self.jobs], f, indent=2)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        executor = cls(**kwargs)
+        with open(path, "r") as f:
+            for content in json.load(f):
+                executor.jobs.append(Job.from_dict(content, {job.id: job for job in executor.jobs}))
+        return executor
+
+    def set_status(self, job, state):
+        self.status[job.id] = {"name": job.name, "state": state, "log": self.log_path(job), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        if self.status_path is not None:
+            tmp_path = f"{self.status_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.status, f, indent=2)
+            os.replace(tmp_path, self.status_path)
+
+    def submit(self, job):
+        # a job without tasks would finish immediately and count as succeeded without running anything
+        if job.n_tasks < 1:
+            raise ValueError(f"{job.name} has no tasks to run on this machine (n_tasks={job.n_tasks}), e.g. a training with --local_gpus 0")
+
+        job.id = str(len(self.jobs))
+        self.jobs.append(job)
+        print(f"Queued {job.name} as local job {job.id}" + (f", after jobs {', '.join(dependency.id for dependency in job.dependencies)}" if len(job.dependencies) > 0 else ""), flush=True)
+        return job.id
+
+    def n_required_cores(self, job):
+        # a job never waits for more cores than the machine has
+        return min(self.n_cores, job.n_tasks * job.cpus_per_task)
+
+    def start(self, job, master_port, gpus):
+        # gpus are the indices of the devices assigned to the job, the only ones its processes see
+        log_path = self.log_path(job)
+        log_file = open(log_path, "w")
+
+        # the indices count the devices this executor sees, which might already be restricted
+        visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES", os.environ.get("HIP_VISIBLE_DEVICES"))
+        devices = [visible_devices.split(',')[gpu] for gpu in gpus] if visible_devices else [str(gpu) for gpu in gpus]
+
+        processes = []
+        for rank in range(job.n_tasks):
+            env = dict(os.environ)
+            env.update({
+                "WORLD_SIZE": str(job.n_tasks),
+                "SLURM_NTASKS": str(job.n_tasks),
+                "SLURM_PROCID": str(rank),
+                "SLURM_LOCALID": str(rank),
+                "SLURM_CPUS_PER_TASK": str(job.cpus_per_task),
+                "SLURM_GPUS_ON_NODE": str(job.n_gpus),
+                "CUDA_VISIBLE_DEVICES": ','.join(devices),
+                "HIP_VISIBLE_DEVICES": ','.join(devices),  # the same for ROCm
+                "MASTER_ADDR": "localhost",
+                "MASTER_PORT": str(master_port),
+            })
+            processes.append(subprocess.Popen(
+                [sys.executable] + job.python_args,
+                cwd=job.chdir, env=env, stdout=log_file, stderr=subprocess.STDOUT
+            ))
+
+        print(f"Started {job.name} (local job {job.id}) with {job.n_tasks} task(s)" + (f" on GPUs {','.join(devices)}" if len(devices) > 0 else "") + f", log in {log_path}", flush=True)
+        return processes, log_file
+
+    def run(self):
+        # runs the job graph, a job starts when all its dependencies succeeded and there are enough free cores and GPUs
+        pending, running, finished = list(self.jobs), {}, {}
+        free_cores, free_gpus = self.n_cores, list(range(self.n_gpus))
+        master_port = 29500
+
+        for job in self.jobs:
+            self.set_status(job, "pending")
+
+        while len(pending) > 0 or len(running) > 0:
+            for job in list(pending):
+                if any(finished.get(dependency.id) is False for dependency in job.dependencies):
+                    print(f"Skipping {job.name} (local job {job.id}), a dependency failed", flush=True)
+                    self.set_status(job, "skipped")
+                    finished[job.id] = False
+                    pending.remove(job)
+                    continue
+
+                if not all(finished.get(dependency.id) for dependency in job.dependencies):
+                    continue
+
+                if job.n_gpus > self.n_gpus:
+                    print(f"Skipping {job.name} (local job {job.id}), it needs {job.n_gpus} GPUs but only {self.n_gpus} are available", flush=True)
+                    self.set_status(job, "skipped")
+                    finished[job.id] = False
+                    pending.remove(job)
+                    continue
+
+                if self.n_required_cores(job) > free_cores or job.n_gpus > len(free_gpus):
+                    continue
+
+                master_port += 1
+                gpus, free_gpus = free_gpus[:job.n_gpus], free_gpus[job.n_gpus:]
+                running[job.id] = (job, gpus, *self.start(job, master_port, gpus))
+                self.set_status(job, "running")
+                free_cores -= self.n_required_cores(job)
+                pending.remove(job)
+
+            for job_id, (job, gpus, processes, log_file) in list(running.items()):
+                if any(process.poll() is None for process in processes):
+                    continue
+
+                log_file.close()
+                success = all(process.returncode == 0 for process in processes)
+                finished[job_id] = success
+                self.set_status(job, "done" if success else "failed")
+                free_cores += self.n_required_cores(job)
+                free_gpus = sorted(free_gpus + gpus)
+                del running[job_id]
+                print(f"{'Finished' if success else 'FAILED'} {job.name} (local job {job_id})", flush=True)
+
+            time.sleep(self.poll_interval)
+
+        n_failed = sum(1 for success in finished.values() if not success)
+        print(f"All local jobs done, {len(finished) - n_failed} succeeded and {n_failed} failed or were skipped", flush=True)
+        return n_failed == 0
+
+
+if __name__ == "__main__":
+    # runs a saved job graph inside an allocation, using all its cores
+    plan_path = sys.argv[1]
+    n_cores = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(plan_path)), "logs")
+
+    executor = LocalExecutor.load(plan_path, n_cores=n_cores, log_dir=log_dir, status_path=f"{plan_path[:-len('.json')]}.status.json")
+    print(f"Running {len(executor.jobs)} jobs from {plan_path} on {n_cores} cores", flush=True)
+    success = executor.run()
+    exit(0 if success else 1)
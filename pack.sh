@@ -0,0 +1,33 @@
+#!/bin/bash
+
+#SBATCH --job-name=PACK
+#SBATCH --account=project_465000498
+#SBATCH --time=24:00:00
+#SBATCH --mem=0
+#SBATCH --cpus-per-task=128
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --partition=small
+
+
+set -o errexit  # Exit the script on any error
+set -o nounset  # Treat any unset variables as an error
+
+# Load modules
+module --quiet purge
+module load LUMI/22.08
+module load cray-python/3.9.12.1
+
+# Set the ${PS1} (needed in the source of the virtual environment for some Python versions)
+export PS1=\$
+
+# Load the virtual environment
+source /project/project_465000144/pytorch_1.13.1/bin/activate
+
+# process arguments
+## the job graph written by schedule.py --pack
+PLAN_PATH=${1}
+
+# run the packed shard, tokenizer and tokenization jobs of many languages in this allocation
+echo "Running executors.py ${PLAN_PATH}"
+python3 executors.py ${PLAN_PATH}
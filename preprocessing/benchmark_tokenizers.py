@@ -0,0 +1,147 @@
+# trains candidate tokenizers for a grid of vocabulary sizes (in parallel, on one uniformly sampled corpus)
+# and measures their compute cost: encoding throughput, fertility and sequence lengths on the UD dev subsets
+#
+# usage: python3 benchmark_tokenizers.py --input_dir /scratch/project_465000498/processed_data/nn/text_shards --language nn
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from argparse import Namespace
+
+from train_tokenizer import initialize_tokenizer, sampled_iterator
+from segmentation import add_pretokenization_arguments, segment_files, segmented_path, load_segmenter
+from shard_stats import count_segments
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory with the text shards')
+    parser.add_argument('--language', type=str, required=True)
+    parser.add_argument('--dev_file', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dev_subsets", "{language}_ud_dev.conllu"), help='UD file used to measure fertility and sequence lengths (the default is in the repository, independent of the working directory)')
+    parser.add_argument('--vocab_sizes', type=int, nargs='+', default=[2**13, 2**14, 2**15, 2**16])
+    parser.add_argument('--min_frequency', type=int, default=10, help='Minimal number of occurences of every candidate subword')
+    parser.add_argument('--sample_size_mb', type=int, default=256, help='Size of the sampled training text for every candidate tokenizer')
+    parser.add_argument('--n_throughput_documents', type=int, default=10_000, help='Number of sampled documents held out to measure the encoding throughput')
+    parser.add_argument('--seq_length', type=int, default=128, help='Sequence length used to count training segments')
+    parser.add_argument('--num_workers', type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save_dir', type=str, default=None, help='Optionally save every candidate tokenizer here')
+    parser.add_argument('--output_file', type=str, default=None, help='Optionally write the result table (markdown) here')
+    add_pretokenization_arguments(parser)
+    args = parser.parse_args()
+
+    args.dev_file = args.dev_file.format(language=args.language)
+    return args
+
+
+def read_conllu_sentences(path):
+    # returns (sentence text, number of syntactic words) pairs
+    sentences, text, n_words = [], None, 0
+    for line in open(path, "r", encoding="utf-8"):
+        line = line.rstrip("\n")
+        if line.startswith("# text = "):
+            text = line[len("# text = "):]
+        elif len(line) == 0:
+            if text is not None:
+                sentences.append((text, n_words))
+            text, n_words = None, 0
+        elif not line.startswith("#") and line.split("\t")[0].isdigit():
+            n_words += 1
+    if text is not None:
+        sentences.append((text, n_words))
+    return sentences
+
+
+# the training corpus and the held-out documents, inherited by the forked workers instead of being pickled
+_training_texts, _heldout_texts, _dev_sentences = None, None, None
+
+
+def benchmark(job):
+    vocab_size, min_frequency, n_cpus, seq_length, save_dir = job
+
+    # split the cores between the tokenizers trained in parallel
+    os.environ["RAYON_RS_NUM_CPUS"] = str(n_cpus)
+
+    tokenizer, trainer = initialize_tokenizer(Namespace(vocab_size=vocab_size, min_frequency=min_frequency))
+
+    start_time = time.perf_counter()
+    tokenizer.train_from_iterator(_training_texts, trainer)
+    training_time = time.perf_counter() - start_time
+
+    if save_dir is not None:
+        tokenizer.save(os.path.join(save_dir, f"tokenizer_{vocab_size}.json"))
+
+    # the same single-threaded encoding as in tokenize_shards.py
+    start_time = time.perf_counter()
+    document_lengths = [len(tokenizer.encode(text, add_special_tokens=False).ids) for text in _heldout_texts]
+    encoding_time = time.perf_counter() - start_time
+    n_bytes = sum(len(text.encode("utf-8")) for text in _heldout_texts)
+
+    sentence_lengths = [len(tokenizer.encode(text, add_special_tokens=False).ids) for text, _ in _dev_sentences]
+    n_subwords, n_words = sum(sentence_lengths), sum(n_words for _, n_words in _dev_sentences)
+
+    return {
+        "vocab_size": tokenizer.get_vocab_size(),
+        "training_time": training_time,
+        "bytes_per_second": n_bytes / encoding_time,
+        "documents_per_second": len(_heldout_texts) / encoding_time,
+        "splits_per_word": n_subwords / max(1, n_words),
+        "subwords_per_sentence": n_subwords / max(1, len(sentence_lengths)),
+        # counted like the .stats.json sidecars of the tokenized shards: half-overlapping windows within every
+        # document (every dev sentence), so they are comparable with the n_segments of shard_stats.py
+        "n_segments": count_segments(sentence_lengths, seq_length),
+        "segments_per_mb": count_segments(document_lengths, seq_length) / (n_bytes / 1024 / 1024),
+    }
+
+
+def format_table(results, language, seq_length):
+    lines = [
+        f"| language | vocab_size | training_time (s) | bytes/s | docs/s | splits_per_word | subwords_per_sentence | n_segments ({seq_length}) | segments/MB ({seq_length}) |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for result in results:
+        lines.append(
+            f"| {language} | {result['vocab_size']} | {result['training_time']:.1f} | {result['bytes_per_second']:,.0f} | {result['documents_per_second']:,.1f} "
+            f"| {result['splits_per_word']:.3f} | {result['subwords_per_sentence']:.2f} | {result['n_segments']} | {result['segments_per_mb']:,.0f} |"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.pretokenization is not None:
+        filenames = sorted(filename for filename in os.listdir(args.input_dir) if filename.endswith(".jsonl.gz") and "train" in filename)
+        segment_files([os.path.join(args.input_dir, filename) for filename in filenames], args.pretokenization, args.num_workers)
+        args.input_dir = os.path.dirname(segmented_path(os.path.join(args.input_dir, filenames[0]), args.pretokenization))
+
+    print(f"Sampling {args.sample_size_mb} MB of text from {args.input_dir}", flush=True)
+    documents = [text for batch in sampled_iterator(args.input_dir, args.sample_size_mb, args.num_workers, args.seed) for text in batch]
+    _training_texts, _heldout_texts = documents[args.n_throughput_documents:], documents[:args.n_throughput_documents]
+
+    _dev_sentences = read_conllu_sentences(args.dev_file)
+    if args.pretokenization is not None:
+        segmenter = load_segmenter(args.pretokenization)
+        _dev_sentences = [(' '.join(word for word in segmenter(text) if len(word.strip()) > 0), n_words) for text, n_words in _dev_sentences]
+    print(f"Loaded {len(_dev_sentences)} sentences from {args.dev_file}", flush=True)
+
+    if args.save_dir is not None:
+        os.makedirs(args.save_dir, exist_ok=True)
+
+    n_parallel = min(len(args.vocab_sizes), args.num_workers)
+    n_cpus = max(1, args.num_workers // n_parallel)
+    jobs = [(vocab_size, args.min_frequency, n_cpus, args.seq_length, args.save_dir) for vocab_size in args.vocab_sizes]
+
+    with multiprocessing.get_context("fork").Pool(n_parallel) as pool:
+        results = pool.map(benchmark, jobs)
+
+    table = format_table(results, args.language, args.seq_length)
+    print(table, flush=True)
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            f.write(table + "\n")
+        with open(f"{args.output_file}.json", "w") as f:
+            json.dump({"language": args.language, "results": results}, f, indent=2)
@@ -0,0 +1,85 @@
+# helpers for restartable preprocessing jobs: checksums, atomic writes and small JSON manifests next to the outputs
+
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+
+def file_checksum(path, chunk_size=16 * 1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    # yields a temporary path in the same directory, renamed to `path` only if the block finishes without an exception
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json_atomic(path, content):
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(content, f, indent=2)
+
+
+def read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def manifest_path(output_file):
+    for suffix in [".pt.gz", ".jsonl.gz"]:
+        if output_file.endswith(suffix):
+            output_file = output_file[:-len(suffix)]
+            break
+    return f"{output_file}.manifest.json"
+
+
+# stage records, written by every job of schedule.py when it succeeds; a rerun of schedule.py skips the stages
+# whose record has the same key (a fingerprint of the inputs and parameters) and whose outputs are all still there
+
+def add_stage_arguments(parser):
+    parser.add_argument('--stage_record', type=str, default=None, help='Path of the stage record written by schedule.py jobs when they succeed')
+    parser.add_argument('--stage_key', type=str, default=None, help='Fingerprint of the inputs and parameters of the stage, stored in the stage record')
+
+
+def write_stage_record(path, key, output_files, throughput=None):
+    # the optional throughput measurements calibrate the cost model of schedule.py --plan (see cost_model.py)
+    if path is None:
+        return
+
+    record = {
+        "key": key,
+        "outputs": {
+            output_file: {"size": os.path.getsize(output_file), "sha256": file_checksum(output_file)}
+            for output_file in output_files
+        },
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if throughput is not None:
+        record["throughput"] = throughput
+    write_json_atomic(path, record)
+
+
+def is_stage_done(path, key):
+    # only compares the sizes of the outputs, checksumming all of them on every rerun would take too long
+    record = read_json(path)
+    if record is None or record["key"] != key:
+        return False
+    return all(
+        os.path.exists(output_file) and os.path.getsize(output_file) == output["size"]
+        for output_file, output in record["outputs"].items()
+    )
@@ -0,0 +1,129 @@
+# word segmentation for languages that don't separate words by spaces (ja, ko, zh, th, my)
+# the segmented text is cached next to the text shards, so that both train_tokenizer.py and tokenize_shards.py
+# read the same segmentation and the (slow) segmenters run only once per document
+
+import gzip
+import json
+import multiprocessing
+import os
+from smart_open import open
+
+from manifest import atomic_output, file_checksum, manifest_path, read_json, write_json_atomic
+
+
+# bump when the segmentation output changes, it invalidates all cached files
+SEGMENTATION_VERSION = 1
+
+PRETOKENIZATION_FLAGS = {
+    "ja": "--do_japanese_pretokenization",
+    "ko": "--do_korean_pretokenization",
+    "zh": "--do_chinese_pretokenization",
+    "th": "--do_thai_pretokenization",
+    "my": "--do_burmese_pretokenization",
+}
+
+
+def add_pretokenization_arguments(parser):
+    for language, flag in PRETOKENIZATION_FLAGS.items():
+        parser.add_argument(flag, dest='pretokenization', action='store_const', const=language, help=f'Segment the {language} text into words before tokenization')
+    parser.set_defaults(pretokenization=None)
+    parser.add_argument('--segmentation_workers', type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 1)), help='Number of processes used for the word segmentation')
+
+
+# one segmenter per process, created lazily because they are expensive to load and can't be pickled
+_segmenter = None
+
+
+def load_segmenter(language):
+    if language == "ja":
+        import fugashi
+        tagger = fugashi.Tagger()
+        return lambda line: [word.surface for word in tagger(line)]
+
+    if language == "ko":
+        from kiwipiepy import Kiwi
+        kiwi = Kiwi()
+        return lambda line: [token.form for token in kiwi.tokenize(line)]
+
+    if language == "zh":
+        import jieba
+        jieba.setLogLevel(60)
+        return lambda line: jieba.lcut(line)
+
+    if language == "th":
+        from pythainlp.tokenize import word_tokenize
+        return lambda line: word_tokenize(line, engine="newmm")
+
+    if language == "my":
+        import pyidaungsu
+        return lambda line: pyidaungsu.tokenize(line, form="word")
+
+    raise ValueError(f"No word segmenter for language {language}")
+
+
+def _initialize_segmenter(language):
+    global _segmenter
+    _segmenter = load_segmenter(language)
+
+
+def segment(text):
+    # keeps the line structure (it's used by the tokenizer normalizer), words are separated by single spaces
+    lines = []
+    for line in text.split("\n"):
+        words = [word.strip() for word in _segmenter(line)]
+        lines.append(' '.join(word for word in words if len(word) > 0))
+    return '\n'.join(lines)
+
+
+def _segment_lines(lines):
+    return [json.dumps(segment(json.loads(line))) + "\n" for line in lines]
+
+
+def _chunks(f, chunk_size):
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def segmented_path(path, language):
+    return os.path.join(os.path.dirname(path), f"segmented_{language}", os.path.basename(path))
+
+
+def is_cached(path, language):
+    cached_path = segmented_path(path, language)
+    manifest = read_json(manifest_path(cached_path))
+    if manifest is None or manifest["version"] != SEGMENTATION_VERSION or not os.path.exists(cached_path):
+        return False
+
+    # the text shard might have been removed after its tokenization, then the cache is all we have
+    return not os.path.exists(path) or file_checksum(path) == manifest["input_sha256"]
+
+
+def segment_files(paths, language, num_workers=1, chunk_size=256):
+    # returns the paths of the segmented files, segmenting only the files that are not cached yet
+    missing_paths = [path for path in paths if not is_cached(path, language)]
+
+    if len(missing_paths) > 0:
+        with multiprocessing.Pool(max(1, num_workers), initializer=_initialize_segmenter, initargs=(language,)) as pool:
+            for path in missing_paths:
+                print(f"Segmenting {path}", flush=True)
+
+                cached_path = segmented_path(path, language)
+                os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+
+                with atomic_output(cached_path) as tmp_path:
+                    with open(path, "rt") as f_in, gzip.open(tmp_path, "wt") as f_out:
+                        for lines in pool.imap(_segment_lines, _chunks(f_in, chunk_size)):
+                            f_out.writelines(lines)
+
+                write_json_atomic(
+                    manifest_path(cached_path),
+                    {"version": SEGMENTATION_VERSION, "language": language, "input_file": path, "input_sha256": file_checksum(path)}
+                )
+
+    return [segmented_path(path, language) for path in paths]
@@ -0,0 +1,175 @@
+# small JSON sidecar with statistics about a tokenized shard, written by tokenize_shards.py next to every train_XXXXX.pt.gz
+# it lets the scheduler, the training script and reporting tools learn about the data without decompressing the shards
+#
+# usage: python3 shard_stats.py --input_dir /scratch/project_465000498/processed_data/nn/tokenized_shards
+
+import argparse
+import json
+import math
+import os
+
+
+SEQ_LENGTHS = [128, 256, 512]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory with the tokenized shards and their .stats.json sidecars')
+    parser.add_argument('--show_shards', action='store_true', help='Print one line for every shard')
+    return parser.parse_args()
+
+
+def stats_path(tokenized_file):
+    if tokenized_file.endswith(".pt.gz"):
+        tokenized_file = tokenized_file[:-len(".pt.gz")]
+    return f"{tokenized_file}.stats.json"
+
+
+def unigrams_path(tokenized_file):
+    # the vocabulary-sized unigram counts are kept out of the .stats.json sidecar, which every training run reads
+    if tokenized_file.endswith(".pt.gz"):
+        tokenized_file = tokenized_file[:-len(".pt.gz")]
+    return f"{tokenized_file}.unigrams.json"
+
+
+def flat_paths(tokenized_file):
+    # the same documents as one flat int16 array of subwords and the int64 offsets of the documents in it,
+    # memory-mapped by encoder-only/dataset.py instead of unpickling millions of small tensors
+    if tokenized_file.endswith(".pt.gz"):
+        tokenized_file = tokenized_file[:-len(".pt.gz")]
+    return f"{tokenized_file}.tokens.npy", f"{tokenized_file}.offsets.npy"
+
+
+def count_segments(lengths, seq_length):
+    # the same segmentation as in encoder-only/dataset.py: windows of (seq_length - 2) subwords with a stride of half a window
+    stride = (seq_length - 2) // 2
+    return sum(math.ceil(length / stride) for length in lengths if length > 0)
+
+
+def compute_unigram_counts(tokenized_documents, vocab_size):
+    import torch
+
+    if len(tokenized_documents) == 0:
+        return [0] * vocab_size
+    all_ids = torch.cat([document.long() for document in tokenized_documents])
+    return torch.bincount(all_ids, minlength=vocab_size).tolist()
+
+
+def compute_stats(tokenized_documents, vocab_size):
+    lengths = [len(document) for document in tokenized_documents]
+    sorted_lengths = sorted(lengths)
+
+    # histogram of document lengths in power-of-two buckets, bucket i counts documents with 2^(i-1) < length <= 2^i (bucket 0 also counts empty documents)
+    length_histogram = [0] * 33
+    for length in lengths:
+        length_histogram[max(0, length - 1).bit_length()] += 1
+    while len(length_histogram) > 1 and length_histogram[-1] == 0:
+        length_histogram.pop()
+
+    def percentile(p):
+        if len(sorted_lengths) == 0:
+            return 0
+        return sorted_lengths[min(len(sorted_lengths) - 1, len(sorted_lengths) * p // 100)]
+
+    return {
+        "n_documents": len(lengths),
+        "n_empty_documents": sum(1 for length in lengths if length == 0),
+        "n_subwords": sum(lengths),
+        "n_segments": {str(seq_length): count_segments(lengths, seq_length) for seq_length in SEQ_LENGTHS},
+        "length": {
+            "min": sorted_lengths[0] if len(lengths) > 0 else 0,
+            "max": sorted_lengths[-1] if len(lengths) > 0 else 0,
+            "mean": sum(lengths) / max(1, len(lengths)),
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "log2_histogram": length_histogram,
+        },
+        "vocab_size": vocab_size,
+    }
+
+
+def write_stats(path, stats):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, path)
+
+
+def read_stats(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def read_shard_stats(tokenized_dir, prefix="train_"):
+    # returns {shard name: stats} for all shards in the directory that have a sidecar
+    shard_stats = {}
+    for filename in sorted(os.listdir(tokenized_dir)):
+        if not filename.startswith(prefix) or not filename.endswith(".stats.json"):
+            continue
+        shard_stats[filename[:-len(".stats.json")]] = read_stats(os.path.join(tokenized_dir, filename))
+    return shard_stats
+
+
+def summarize(shard_stats):
+    shard_stats = list(shard_stats)
+    summary = {
+        "n_shards": len(shard_stats),
+        "n_documents": sum(stats["n_documents"] for stats in shard_stats),
+        "n_subwords": sum(stats["n_subwords"] for stats in shard_stats),
+        "n_segments": {
+            str(seq_length): sum(stats["n_segments"][str(seq_length)] for stats in shard_stats)
+            for seq_length in SEQ_LENGTHS
+        },
+    }
+    summary["min_shard_subwords"] = min((stats["n_subwords"] for stats in shard_stats), default=0)
+    summary["max_shard_subwords"] = max((stats["n_subwords"] for stats in shard_stats), default=0)
+    return summary
+
+
+def read_unigram_counts(tokenized_dir, shard_stats):
+    # returns the unigram counts of every shard that has them, older .stats.json sidecars still contain them
+    unigram_counts = []
+    for name, stats in shard_stats.items():
+        path = unigrams_path(os.path.join(tokenized_dir, name))
+        if os.path.exists(path):
+            unigram_counts.append(read_stats(path))
+        elif "unigram_counts" in stats:
+            unigram_counts.append(stats["unigram_counts"])
+    return unigram_counts
+
+
+def merge_unigram_counts(unigram_counts):
+    merged = None
+    for counts in unigram_counts:
+        if merged is None:
+            merged = list(counts)
+        else:
+            merged = [a + b for a, b in zip(merged, counts)]
+    return merged or []
+
+
+def print_report(shard_stats, unigram_counts, show_shards=False):
+    if show_shards:
+        print(f"{'shard':<16} {'documents':>12} {'subwords':>15} {'mean length':>12} {'p99 length':>11}")
+        for name, stats in shard_stats.items():
+            print(f"{name:<16} {stats['n_documents']:>12,} {stats['n_subwords']:>15,} {stats['length']['mean']:>12.1f} {stats['length']['p99']:>11,}")
+        print()
+
+    summary = summarize(shard_stats.values())
+    print(f"Shards: {summary['n_shards']}")
+    print(f"Documents: {summary['n_documents']:,}")
+    print(f"Subwords: {summary['n_subwords']:,} (smallest shard {summary['min_shard_subwords']:,}, largest shard {summary['max_shard_subwords']:,})")
+    for seq_length, n_segments in summary["n_segments"].items():
+        print(f"Segments of length {seq_length}: {n_segments:,}")
+
+    unigram_counts = merge_unigram_counts(unigram_counts)
+    n_unused = sum(1 for count in unigram_counts if count == 0)
+    if len(unigram_counts) > 0:
+        print(f"Unused vocabulary entries: {n_unused:,} out of {len(unigram_counts):,}", flush=True)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    shard_stats = read_shard_stats(args.input_dir)
+    print_report(shard_stats, read_unigram_counts(args.input_dir, shard_stats), args.show_shards)
@@ -7,8 +7,11 @@ import math
 import json
 from tqdm import tqdm
 import random
+import time
 from statistics import mean
 
+from manifest import add_stage_arguments, write_stage_record
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -17,10 +20,22 @@ def parse_args():
     parser.add_argument('--shards', type=str, required=True)
     parser.add_argument('--create_validation', action='store_true')
     parser.add_argument('--sample_power', type=float, default=0.0)
+    parser.add_argument('--n_validation_documents', type=int, default=10_000)
+    add_stage_arguments(parser)
     return parser.parse_args()
 
 
-def shard(input_files, output_dir, shards, create_validation=False, sample_power=0.0):
+def open_input(filename):
+    # HPLT files are zstd-compressed jsonl, small test files (data/test) are plain jsonl
+    if not filename.endswith(".zst"):
+        return open(filename, "rt", encoding="utf-8")
+
+    dctx = zstd.ZstdDecompressor()
+    reader = dctx.stream_reader(open(filename, "rb"), closefd=True)
+    return io.TextIOWrapper(reader, encoding='utf-8')
+
+
+def shard(input_files, output_dir, shards, create_validation=False, sample_power=0.0, n_validation_documents=10_000):
 
     random.seed(42)
 
@@ -33,45 +48,43 @@ def shard(input_files, output_dir, shards, create_validation=False, sample_power
     if create_validation:
         validation_file = gzip.open(os.path.join(output_dir, "validation.jsonl.gz"), "wt")
 
-    n_validation_documents = 10_000
     n_processed_documents = 0
     n_rejected_documents = 0
+    n_bytes = 0
 
     # iterate through all input files
     for filename in input_files:
 
         # open/decompress every .json.zst file
-        dctx = zstd.ZstdDecompressor()
-        with open(filename, "rb") as f:
-            with dctx.stream_reader(f) as reader:
-                text_stream = io.TextIOWrapper(reader, encoding='utf-8')
-                for line in tqdm(text_stream):
-                    line = json.loads(line)
-                    document = line["text"].strip()
-
-                    if len(document) == 0:
+        with open_input(filename) as text_stream:
+            for line in tqdm(text_stream):
+                n_bytes += len(line.encode("utf-8"))
+                line = json.loads(line)
+                document = line["text"].strip()
+
+                if len(document) == 0:
+                    continue
+
+                if sample_power > 0.0:
+                    scores = line["scores"]
+                    scores = [float(score) for score in scores]
+                    mean_score = mean(scores)
+
+                    if random.random() > math.pow(mean_score + 0.2, sample_power):
+                        n_rejected_documents += 1
                         continue
 
-                    if sample_power > 0.0:
-                        scores = line["scores"]
-                        scores = [float(score) for score in scores]
-                        mean_score = mean(scores)
+                if n_processed_documents == 0:
+                    print(f"\nFirst document: {document}\n\n", flush=True)
 
-                        if random.random() > math.pow(mean_score + 0.2, sample_power):
-                            n_rejected_documents += 1
-                            continue
+                # write to validation file if shard_index < validation_size
+                if create_validation and n_processed_documents < n_validation_documents:
+                    validation_file.write(json.dumps(document) + "\n")
+                else:
+                    shard_file = shard_files[n_processed_documents % len(shard_files)]
+                    shard_file.write(json.dumps(document) + "\n")
 
-                    if n_processed_documents == 0:
-                        print(f"\nFirst document: {document}\n\n", flush=True)
-
-                    # write to validation file if shard_index < validation_size
-                    if create_validation and n_processed_documents < n_validation_documents:
-                        validation_file.write(json.dumps(document) + "\n")
-                    else:
-                        shard_file = shard_files[n_processed_documents % len(shard_files)]
-                        shard_file.write(json.dumps(document) + "\n")
-
-                    n_processed_documents += 1
+                n_processed_documents += 1
 
     # close all shard files
     for shard_file in shard_files:
@@ -82,6 +95,8 @@ def shard(input_files, output_dir, shards, create_validation=False, sample_power
     if sample_power > 0.0:
         print(f"Rejected {n_rejected_documents} documents ({n_rejected_documents / (n_processed_documents + n_rejected_documents) * 100.0:.2f}%)", flush=True)
 
+    return n_processed_documents + n_rejected_documents, n_bytes
+
  
 if __name__ == "__main__":
     args = parse_args()
@@ -89,4 +104,12 @@ if __name__ == "__main__":
     args.input_files = args.input_files.split(",")
     args.shards = [int(shard) for shard in args.shards.split(",")]
 
-    shard(args.input_files, args.output_dir, args.shards, args.create_validation, args.sample_power)
+    start_time = time.time()
+    n_documents, n_bytes = shard(args.input_files, args.output_dir, args.shards, args.create_validation, args.sample_power, args.n_validation_documents)
+    throughput = {"stage": "shard", "seconds": time.time() - start_time, "n_documents": n_documents, "n_bytes": n_bytes}
+    print(f"Sharded {n_documents} documents in {throughput['seconds']:.0f} s ({n_documents / throughput['seconds']:.0f} docs/s, {n_bytes / 1024 / 1024 / throughput['seconds']:.1f} MB/s)", flush=True)
+
+    output_files = [os.path.join(args.output_dir, f"train_{i:05d}.jsonl.gz") for i in args.shards]
+    if args.create_validation:
+        output_files.append(os.path.join(args.output_dir, "validation.jsonl.gz"))
+    write_stage_record(args.stage_record, args.stage_key, output_files, throughput)
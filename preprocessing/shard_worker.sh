@@ -29,8 +29,8 @@ INPUT_PATHS=${1}
 OUTPUT_DIR=${2}
 SHARDS=${3}
 SAMPLE_POWER=${4:-"0.0"}
-CREATE_VALIDATION=${5:-""}
+EXTRA_ARGS=${@:5}
 
 # run the script
-echo "Running shard_worker.py --input_paths ${INPUT_PATHS} --output_dir ${OUTPUT_DIR} --shards ${SHARDS} ${CREATE_VALIDATION} --sample_power ${SAMPLE_POWER}"
-python3 shard_worker.py --input_files ${INPUT_PATHS} --output_dir ${OUTPUT_DIR} --shards ${SHARDS} ${CREATE_VALIDATION} --sample_power ${SAMPLE_POWER}
+echo "Running shard_worker.py --input_paths ${INPUT_PATHS} --output_dir ${OUTPUT_DIR} --shards ${SHARDS} --sample_power ${SAMPLE_POWER} ${EXTRA_ARGS}"
+python3 shard_worker.py --input_files ${INPUT_PATHS} --output_dir ${OUTPUT_DIR} --shards ${SHARDS} --sample_power ${SAMPLE_POWER} ${EXTRA_ARGS}
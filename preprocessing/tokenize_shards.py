@@ -10,14 +10,25 @@ import re
 from smart_open import open
 import torch
 import gzip
+import numpy as np
+import time
+import resource
 from tqdm import tqdm
 
+from shard_stats import compute_stats, compute_unigram_counts, flat_paths, stats_path, unigrams_path, write_stats
+from manifest import add_stage_arguments, atomic_output, file_checksum, manifest_path, read_json, write_json_atomic, write_stage_record
+from segmentation import add_pretokenization_arguments, segment_files
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_files', type=str, required=True)
     parser.add_argument('--output_files', type=str, required=True)
     parser.add_argument('--tokenizer_path', type=str, required=True)
+    parser.add_argument('--remove_input', action='store_true', help='Remove the input text shard after its tokenization is verified')
+    parser.add_argument('--write_pt_gz', action='store_true', help='Also write the gzipped list of tensors (the output file itself) for older training code, next to the flat arrays')
+    add_pretokenization_arguments(parser)
+    add_stage_arguments(parser)  # comma-separated, one record and key for every input file
     return parser.parse_args()
 
 
@@ -34,6 +45,47 @@ def tokenize(tokenizer, text):
     return ids
 
 
+def recorded_checksums(manifest, output_file):
+    # {path: sha256} of the data files of a tokenized shard, the output file itself only exists with --write_pt_gz
+    tokens_path, offsets_path = flat_paths(output_file)
+    checksums = {tokens_path: manifest.get("tokens_sha256"), offsets_path: manifest.get("offsets_sha256")}
+    if manifest.get("output_sha256") is not None:
+        checksums[output_file] = manifest["output_sha256"]
+    return checksums
+
+
+def existing_outputs(output_file):
+    # all files of a tokenized shard, for its stage record
+    output_files = [output_file, *flat_paths(output_file), stats_path(output_file), unigrams_path(output_file), manifest_path(output_file)]
+    return [path for path in output_files if os.path.exists(path)]
+
+
+def is_done(manifest, input_file, output_file, tokenizer_checksum, write_pt_gz):
+    if manifest is None or manifest["tokenizer_sha256"] != tokenizer_checksum:
+        return False
+    if not os.path.exists(stats_path(output_file)) or (write_pt_gz and manifest.get("output_sha256") is None):
+        return False
+    if os.path.exists(input_file) and file_checksum(input_file) != manifest["input_sha256"]:
+        return False
+    return all(
+        checksum is not None and os.path.exists(path) and file_checksum(path) == checksum
+        for path, checksum in recorded_checksums(manifest, output_file).items()
+    )
+
+
+def write_flat(tokenized_documents, output_file):
+    tokens_path, offsets_path = flat_paths(output_file)
+    tokens = torch.cat(tokenized_documents) if len(tokenized_documents) > 0 else torch.zeros(0, dtype=torch.int16)
+    offsets = np.zeros(len(tokenized_documents) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(document) for document in tokenized_documents])
+
+    # np.save would append .npy to the temporary path, so it gets an open file instead
+    for path, array in [(tokens_path, tokens.numpy()), (offsets_path, offsets)]:
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -51,11 +103,37 @@ if __name__ == "__main__":
     
     input_file = args.input_files[rank]
     output_file = args.output_files[rank]
+    stage_record = args.stage_record.split(",")[rank] if args.stage_record is not None else None
+    stage_key = args.stage_key.split(",")[rank] if args.stage_key is not None else None
+    tokenizer_checksum = file_checksum(args.tokenizer_path)
+
+    # skip the file if a previous run already tokenized it with the same tokenizer
+    manifest = read_json(manifest_path(output_file))
+    if is_done(manifest, input_file, output_file, tokenizer_checksum, args.write_pt_gz):
+        print(f"{output_file} is already tokenized with this tokenizer, skipping", flush=True)
+        write_stage_record(stage_record, stage_key, existing_outputs(output_file))
+        if args.remove_input and os.path.exists(input_file):
+            os.remove(input_file)
+        exit(0)
+
+    if not os.path.exists(input_file):
+        print(f"ERROR: {input_file} does not exist and {output_file} is not a valid tokenization of it, the text shard has to be recreated", flush=True)
+        exit(1)
+
+    input_checksum = file_checksum(input_file)
+    start_time = time.time()
+
+    # reuse the word segmentation cached by train_tokenizer.py (or create it if it's missing)
+    if args.pretokenization is not None:
+        text_file = segment_files([input_file], args.pretokenization, args.segmentation_workers)[0]
+    else:
+        text_file = input_file
 
     # tokenize file
     tokenized_documents = []
-    n_subwords = 0
-    for i, line in enumerate(tqdm(open(input_file, 'rt'))):
+    n_subwords, n_bytes = 0, 0
+    for i, line in enumerate(tqdm(open(text_file, 'rt'))):
+        n_bytes += len(line.encode("utf-8"))
         document = json.loads(line)
         tokenized_document = tokenize(tokenizer, document)
         tokenized_documents.append(tokenized_document)
@@ -68,11 +146,52 @@ if __name__ == "__main__":
                 print(tokenizer.decode([token]))
             print(flush=True)
 
-    # save the tokenized documents
-    with gzip.GzipFile(output_file, 'wb') as f:
-        torch.save(tokenized_documents, f)
-
-    # remove the original file
-    os.remove(input_file)
+    # save the tokenized documents as the flat arrays memory-mapped by the training, the gzipped list of tensors
+    # (three times the storage) only on request; every file is renamed into place only after it's completely written
+    if args.write_pt_gz:
+        with atomic_output(output_file) as tmp_output_file:
+            with gzip.GzipFile(tmp_output_file, 'wb') as f:
+                torch.save(tokenized_documents, f)
+    elif os.path.exists(output_file):
+        os.remove(output_file)  # left over from an earlier tokenization
+    write_flat(tokenized_documents, output_file)
+
+    # save the statistics sidecars, so that nobody else has to decompress the shard to learn about it
+    write_stats(stats_path(output_file), compute_stats(tokenized_documents, tokenizer.get_vocab_size()))
+    write_stats(unigrams_path(output_file), compute_unigram_counts(tokenized_documents, tokenizer.get_vocab_size()))
+
+    # the manifest is written last, its presence marks a finished tokenization
+    write_json_atomic(
+        manifest_path(output_file),
+        {
+            "input_file": input_file,
+            "input_sha256": input_checksum,
+            "tokenizer_path": args.tokenizer_path,
+            "tokenizer_sha256": tokenizer_checksum,
+            "output_file": output_file,
+            "output_sha256": file_checksum(output_file) if args.write_pt_gz else None,
+            "tokens_sha256": file_checksum(flat_paths(output_file)[0]),
+            "offsets_sha256": file_checksum(flat_paths(output_file)[1]),
+            "n_documents": len(tokenized_documents),
+            "n_subwords": n_subwords,
+        }
+    )
+
+    throughput = {
+        "stage": "tokenize",
+        "seconds": time.time() - start_time,
+        "n_documents": len(tokenized_documents),
+        "n_subwords": n_subwords,
+        "n_bytes": n_bytes,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    write_stage_record(stage_record, stage_key, existing_outputs(output_file), throughput)
+
+    # remove the original file only when the tokenized one is safely on disk
+    if args.remove_input:
+        os.remove(input_file)
+        if args.pretokenization is not None:
+            os.remove(text_file)
+            os.remove(manifest_path(text_file))
 
     print(f"Tokenized {len(tokenized_documents)} documents with {n_subwords} subwords in total")
@@ -27,9 +27,10 @@ source /project/project_465000144/pytorch_1.13.1/bin/activate
 INPUT_PATHS=${1}
 OUTPUT_PATHS=${2}
 TOKENIZER_PATH=${3}
+EXTRA_ARGS=${@:4}
 
 export WORLD_SIZE=$SLURM_NTASKS
 
 # run the script
-echo "Running tokenize_shards.py --input_files=${INPUT_PATHS} --output_files=${OUTPUT_PATHS} --tokenizer_path=${TOKENIZER_PATH}"
-srun -W 0 python3 tokenize_shards.py --input_files=${INPUT_PATHS} --output_files=${OUTPUT_PATHS} --tokenizer_path=${TOKENIZER_PATH}
+echo "Running tokenize_shards.py --input_files=${INPUT_PATHS} --output_files=${OUTPUT_PATHS} --tokenizer_path=${TOKENIZER_PATH} ${EXTRA_ARGS}"
+srun -W 0 python3 tokenize_shards.py --input_files=${INPUT_PATHS} --output_files=${OUTPUT_PATHS} --tokenizer_path=${TOKENIZER_PATH} ${EXTRA_ARGS}
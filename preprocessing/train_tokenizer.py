@@ -3,34 +3,170 @@ import json
 from smart_open import open
 import argparse
 import re
+import math
+import heapq
+import random
+import time
+import queue
+import multiprocessing
 from collections import Counter
 
 from tokenizers.models import WordPiece
 from tokenizers.trainers import WordPieceTrainer
 from tokenizers import Tokenizer, pre_tokenizers, decoders, processors, Regex, normalizers
 
+from segmentation import add_pretokenization_arguments, segment_files, segmented_path
+from manifest import add_stage_arguments, file_checksum, read_json, write_json_atomic, write_stage_record
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='BERT sharding')
     parser.add_argument('--input_dir', type=str, required=True, default="/scratch/project_465000498/processed_data/nn/shards")
     parser.add_argument('--output_dir', type=str, required=True, default="/scratch/project_465000498/processed_data/nn")
-    parser.add_argument('--num_sampled_files', type=int, default=32)
+    parser.add_argument('--sample_size_mb', type=int, default=2048, help='Size of the uniformly sampled training text for the tokenizer (in MB of UTF-8 text)')
+    parser.add_argument('--num_workers', type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())), help='Number of shards read in parallel, 0 reads them one by one in the main process')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Number of documents in every batch passed to the trainer')
+    parser.add_argument('--max_queued_batches', type=int, default=64, help='Maximal number of prefetched batches waiting for the trainer')
+    parser.add_argument('--compare_reading', action='store_true', help='First train a throwaway tokenizer on serially read text and compare its CPU utilization with the prefetching readers')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--n_shards', type=int, default=None, help='Train only on the first N shards, so that the tokenizer can start before all shards are written')
     parser.add_argument('--vocab_size', type=int, default=2**15, help='Number of subwords in the trained tokenizer')
     parser.add_argument('--min_frequency', type=int, default=10, help='Minimal number of occurences of every candidate subword')
     parser.add_argument('--do_calculate_stats', action='store_true', help='Calculate statistics about the dataset')
+    parser.add_argument('--renyi_powers', type=float, nargs='+', default=[2.5], help='Powers of the Renyi efficiency reported by --do_calculate_stats')
+    add_stage_arguments(parser)
+    add_pretokenization_arguments(parser)
     args = parser.parse_args()
 
     return args
 
 
+def limit_repetitions(s):
+    return re.sub(r'(\S)(\1{7,})', lambda m: m.group(1) * 8, s)
+
+
+def sample_shard(path, budget, seed):
+    # bottom-k reservoir sampling: every document gets a random key and we keep the documents with the smallest keys
+    # whose total size just reaches the byte budget, that is a uniform sample without replacement
+    rng = random.Random(seed)
+    heap, size = [], 0  # max-heap on the keys, stored as (-key, position, text, n_bytes)
+    for position, line in enumerate(open(path, "rt")):
+        key = rng.random()
+        if size >= budget and key >= -heap[0][0]:
+            continue
+
+        text = json.loads(line)
+        text = text.rstrip()
+        text = limit_repetitions(text)
+        if len(text) == 0:
+            continue
+
+        n_bytes = len(text.encode("utf-8"))
+        heapq.heappush(heap, (-key, position, text, n_bytes))
+        size += n_bytes
+
+        while size - heap[0][3] >= budget:
+            size -= heapq.heappop(heap)[3]
+
+    return [text for _, _, text, _ in heap], size
+
+
+# the bounded queue shared with the reader processes, set in every worker by the pool initializer
+_batch_queue = None
+
+
+def _initialize_reader(batch_queue):
+    global _batch_queue
+    _batch_queue = batch_queue
+
+
+def _read_shard(job):
+    batch_size = job[-1]
+    texts, size = sample_shard(*job[:-1])
+    for i in range(0, len(texts), batch_size):
+        _batch_queue.put(texts[i : i + batch_size])
+    _batch_queue.put(None)  # marks a finished shard
+    return size, len(texts)
+
+
+def training_shard_filenames(dir_path, n_shards=None):
+    # with n_shards, only the first shards (train_00000 to train_{n_shards - 1}), the others might still be written
+    filenames = sorted(filename for filename in os.listdir(dir_path) if filename.endswith(".jsonl.gz") and "train" in filename)
+    if n_shards is not None:
+        filenames = [filename for filename in filenames if filename.startswith("train_") and int(filename[len("train_"):len("train_") + 5]) < n_shards]
+    return filenames
+
+
+def sampled_iterator(dir_path, sample_size_mb, num_workers, seed, batch_size=1024, max_queued_batches=64, n_shards=None):
+    filenames = training_shard_filenames(dir_path, n_shards)
+
+    # the shards are filled round-robin by shard_worker.py, so an equal budget per shard gives a uniform sample of all documents
+    budget = sample_size_mb * 1024 * 1024 // len(filenames)
+    jobs = [(os.path.join(dir_path, filename), budget, seed + i) for i, filename in enumerate(filenames)]
+
+    total_size, n_documents = 0, 0
+
+    # serial reading in the main process, mostly useful as a baseline for the prefetching below
+    if num_workers == 0:
+        for job in jobs:
+            texts, size = sample_shard(*job)
+            total_size += size
+            n_documents += len(texts)
+            for i in range(0, len(texts), batch_size):
+                yield texts[i : i + batch_size]
+
+    # one reader per shard in a process pool, the readers push batches to a bounded queue so that they never run too far ahead of the trainer;
+    # the pool is created lazily, from inside train_from_iterator when the Rust trainer threads already run, so the readers
+    # are spawned instead of forked (forking a multi-threaded process can deadlock the child)
+    else:
+        context = multiprocessing.get_context("spawn")
+        batch_queue = context.Queue(max_queued_batches)
+        with context.Pool(min(num_workers, len(jobs)), initializer=_initialize_reader, initargs=(batch_queue,)) as pool:
+            result = pool.map_async(_read_shard, [job + (batch_size,) for job in jobs])
+
+            n_finished_shards = 0
+            while n_finished_shards < len(jobs):
+                try:
+                    batch = batch_queue.get(timeout=1.0)
+                except queue.Empty:
+                    if result.ready() and not result.successful():
+                        result.get()  # re-raises the exception from the reader
+                    continue
+
+                if batch is None:
+                    n_finished_shards += 1
+                    continue
+                yield batch
+
+            for size, n_texts in result.get():
+                total_size += size
+                n_documents += n_texts
+
+    print(f"Sampled {n_documents:,} documents with {total_size / 1024 / 1024:.2f} MB of text from {len(filenames)} shards", flush=True)
+
+
+def train(tokenizer, trainer, iterator):
+    # also measures how well the trainer threads are utilized, it tells us if the readers keep up with the trainer;
+    # returns the wall time and the CPU utilization of the trainer process (in cores)
+    start_time, start_cpu = time.perf_counter(), os.times()
+    tokenizer.train_from_iterator(iterator, trainer)
+    wall_time, end_cpu = time.perf_counter() - start_time, os.times()
+
+    trainer_cpu_time = (end_cpu.user - start_cpu.user) + (end_cpu.system - start_cpu.system)
+    reader_cpu_time = (end_cpu.children_user - start_cpu.children_user) + (end_cpu.children_system - start_cpu.children_system)
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+    print(f"Tokenizer training took {wall_time:.1f} s", flush=True)
+    print(f"Trainer process CPU utilization: {trainer_cpu_time / wall_time:.2f} cores ({trainer_cpu_time / wall_time / n_cores * 100.0:.1f}% of {n_cores} available cores)")
+    print(f"Reader processes CPU utilization: {reader_cpu_time / wall_time:.2f} cores", flush=True)
+
+    return wall_time, trainer_cpu_time / wall_time
+
+
 def initialize_tokenizer(args):
     special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
     special_tokens += [f"[MASK_{i}]" for i in range(1, 100)] + ['█']
 
-    number_of_training_shards = len([filename for filename in os.listdir(args.input_dir) if filename.endswith(".jsonl.gz") and "train" in filename])
-    if number_of_training_shards == 1:
-        args.vocab_size //= 2
-
     tokenizer = Tokenizer(WordPiece(unk_token="[UNK]"))
     tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
 
@@ -85,28 +221,50 @@ def initialize_tokenizer(args):
     return tokenizer, trainer
 
 
-def calculate_stats(tokenizer, args):
-    import tokenization_scorer
+def renyi_efficiency(counter, power):
+    # Renyi entropy of the unigram distribution normalized by log of the number of distinct subwords,
+    # the same quantity as tokenization_scorer.score(..., metric="renyi") but computed from the frequencies only
+    n_tokens = sum(counter.values())
+    if power == 1.0:
+        entropy = -sum(freq / n_tokens * math.log2(freq / n_tokens) for freq in counter.values())
+    else:
+        entropy = math.log2(sum((freq / n_tokens) ** power for freq in counter.values())) / (1.0 - power)
+    return entropy / math.log2(len(counter))
 
-    counter, n_words = Counter(), 0
-    all_tokens = []
-    for i, document in enumerate(open(f"{args.input_dir}/validation.jsonl.gz", "rt")):
+
+def validation_batches(path, batch_size):
+    batch = []
+    for document in open(path, "rt"):
         text = json.loads(document)
         text = text.rstrip()
         text = limit_repetitions(text)
-        if len(text) > 0:
+        if len(text) == 0:
+            continue
+
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def calculate_stats(tokenizer, args):
+    # only the subword frequencies are kept in memory, the documents are encoded in parallel batches by the Rust tokenizer
+    counter, n_words = Counter(), 0
+    for i, batch in enumerate(validation_batches(f"{args.input_dir}/validation.jsonl.gz", args.batch_size)):
+        encodings = tokenizer.encode_batch(batch)
+        for text, encoding in zip(batch, encodings):
             n_words += len(text.split())
-            encoding = tokenizer.encode(text)
-            tokens = encoding.tokens
-            counter.update(tokens)
-            all_tokens += tokens
-
-            if i == 0:
-                print("Example of tokenization:")
-                print(text)
-                print(tokenizer.decode(encoding.ids))
-                for j in encoding.ids:
-                    print(j, tokenizer.id_to_token(j))
+            counter.update(encoding.tokens)
+
+        if i == 0:
+            print("Example of tokenization:")
+            print(batch[0])
+            print(tokenizer.decode(encodings[0].ids))
+            for j in encodings[0].ids:
+                print(j, tokenizer.id_to_token(j))
 
     sorted_subwords = counter.most_common()
 
@@ -114,53 +272,67 @@ def calculate_stats(tokenizer, args):
     print(f"Average splits per word: {n_subwords / n_words:.3f}", flush=True)
 
     f_95 = sorted_subwords[len(sorted_subwords) * 95 // 100][1]
-    renyi_score = tokenization_scorer.score(' '.join(all_tokens), metric="renyi", power=2.5)
+    renyi_scores = {power: renyi_efficiency(counter, power) for power in args.renyi_powers}
 
     print(f"F_{{95%}} is {f_95}\n")
-    print(f"Renyi score is {renyi_score}\n")
+    for power, renyi_score in renyi_scores.items():
+        print(f"Renyi score (power {power}) is {renyi_score}\n")
 
     with open(f"{args.output_dir}/tokenizer_stats.txt", "w") as f:
         f.write(f"Vocabulary size: {args.vocab_size}\n")
         f.write(f"Average splits per word: {n_subwords / n_words:.3f}\n")
         f.write(f"F_{{95%}} is {f_95}\n")
-        f.write(f"Renyi score is {renyi_score}\n\n")
+        for power, renyi_score in renyi_scores.items():
+            f.write(f"Renyi score (power {power}) is {renyi_score}\n")
+        f.write("\n")
         sorted_subwords_str = '\n\t'.join(f"{freq}: {subword}" for subword, freq in sorted_subwords)
         f.write(f"Sorted subwords:\n\t{sorted_subwords_str}\n")
 
 
 if __name__ == "__main__":
     args = parse_args()
+    start_time = time.time()
+
+    # segment all shards (and cache the segmentation for tokenize_shards.py), then train on the segmented text
+    if args.pretokenization is not None:
+        print(f"Segmenting the text shards into words", flush=True)
+        filenames = training_shard_filenames(args.input_dir, args.n_shards) + ["validation.jsonl.gz"]
+        segment_files([os.path.join(args.input_dir, filename) for filename in filenames], args.pretokenization, args.segmentation_workers)
+        args.input_dir = os.path.dirname(segmented_path(os.path.join(args.input_dir, filenames[0]), args.pretokenization))
+
+    number_of_training_shards = len(training_shard_filenames(args.input_dir, args.n_shards))
+    if number_of_training_shards == 1:
+        args.vocab_size //= 2
 
     print(f"Initializing a WordPiece tokenizer", flush=True)
     tokenizer, trainer = initialize_tokenizer(args)
 
-    print("Training the tokenizer", flush=True)
-    def limit_repetitions(s):
-        return re.sub(r'(\S)(\1{7,})', lambda m: m.group(1) * 8, s)
-
-    def iterator(dir_path, num_sampled_files):
-        for filename in sorted(os.listdir(dir_path)):
-            if num_sampled_files <= 0:
-                break
-
-            if not filename.endswith(".jsonl.gz") or "train" not in filename:
-                continue
-
-            for line in open(os.path.join(dir_path, filename), "rt"):
-                text = json.loads(line)
-                text = text.rstrip()
-                text = limit_repetitions(text)
-                if len(text) == 0:
-                    continue
-                yield text
+    # the same training with the text read serially by the main process, as a baseline for the readers
+    if args.compare_reading:
+        print("Training a baseline tokenizer on serially read text", flush=True)
+        baseline_tokenizer, baseline_trainer = initialize_tokenizer(args)
+        iterator = sampled_iterator(args.input_dir, args.sample_size_mb, 0, args.seed, args.batch_size, args.max_queued_batches, args.n_shards)
+        baseline_time, baseline_utilization = train(baseline_tokenizer, baseline_trainer, iterator)
 
-            num_sampled_files -= 1
+    print("Training the tokenizer", flush=True)
+    iterator = sampled_iterator(args.input_dir, args.sample_size_mb, args.num_workers, args.seed, args.batch_size, args.max_queued_batches, args.n_shards)
+    wall_time, utilization = train(tokenizer, trainer, iterator)
 
-    tokenizer.train_from_iterator(iterator(args.input_dir, args.num_sampled_files), trainer)
+    if args.compare_reading:
+        print(f"Serial reading: {baseline_time:.1f} s, trainer utilization {baseline_utilization:.2f} cores", flush=True)
+        print(f"{args.num_workers} readers: {wall_time:.1f} s, trainer utilization {utilization:.2f} cores ({baseline_time / wall_time:.2f}x faster)", flush=True)
 
     print("Saving the tokenizer", flush=True)
     tokenizer.save(f"{args.output_dir}/tokenizer.json")
+
+    # the training accepts only the shards tokenized with this tokenizer (shards.json is written by schedule.py)
+    shards_path = f"{args.output_dir}/tokenized_shards/shards.json"
+    if os.path.exists(shards_path):
+        write_json_atomic(shards_path, {**read_json(shards_path), "tokenizer_sha256": file_checksum(f"{args.output_dir}/tokenizer.json")})
     
     if args.do_calculate_stats:
         calculate_stats(tokenizer, args)
 
+    throughput = {"stage": "tokenizer", "seconds": time.time() - start_time, "sample_size_mb": args.sample_size_mb, "pretokenization": args.pretokenization}
+    write_stage_record(args.stage_record, args.stage_key, [f"{args.output_dir}/tokenizer.json"], throughput)
+
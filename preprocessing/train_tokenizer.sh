@@ -27,7 +27,8 @@ source /project/project_465000144/pytorch_1.13.1/bin/activate
 ## input and output directories
 INPUT_DIR=${1}
 OUTPUT_DIR=${2}
+EXTRA_ARGS=${@:3}
 
 # run the script
-echo "Running train_tokenizer.py input_dir ${INPUT_DIR} output_dir ${OUTPUT_DIR} --do_calculate_stats"
-python3 train_tokenizer.py --input_dir ${INPUT_DIR} --output_dir ${OUTPUT_DIR} --do_calculate_stats
+echo "Running train_tokenizer.py input_dir ${INPUT_DIR} output_dir ${OUTPUT_DIR} --do_calculate_stats ${EXTRA_ARGS}"
+python3 train_tokenizer.py --input_dir ${INPUT_DIR} --output_dir ${OUTPUT_DIR} --do_calculate_stats ${EXTRA_ARGS}
@@ -1,13 +1,30 @@
 # this script is used to schedule the preprocessing and training jobs for a language
 # it takes as input the language, the input directory, the output directory, the shard size and optinally the sample power
 # it then schedules the shard workers, the tokenizer training, the shard tokenization and the BERT training
+# every finished job writes a stage record to output_dir/manifest, a rerun only schedules the stages with changed inputs or parameters
+# the jobs either go to SLURM (--executor slurm, the default) or run on this machine (--executor local), e.g.:
+#     python3 schedule.py --language en --input_dir data/test --output_dir data/test_output --executor local --train_args "--max_steps 100 --batch_size 16"
+# the wall time and cost of every stage can be predicted beforehand, without submitting anything (--plan), e.g.:
+#     python3 schedule.py --language nn --input_dir /scratch/project_465000498/one/cleaned/nn --output_dir /scratch/project_465000498/processed_data/nn --plan --target_tokens 100e9
+# many small languages can be preprocessed together in a few shared allocations (--pack), e.g.:
+#     python3 schedule.py --language fo,se,kl --input_dir /scratch/project_465000498/one/cleaned/{language} --output_dir /scratch/project_465000498/processed_data/{language} --pack
 
 import argparse
 import os
-import gzip
+import sys
 import math
-import subprocess
-import shutil
+import json
+import time
+import hashlib
+
+from executors import Job, SlurmExecutor, LocalExecutor
+from cost_model import CostModel, SHARD_CORES, TOKENIZER_CORES, TOKENIZE_CORES_PER_RANK, GPUS_PER_NODE, JOB_STARTUP_SECONDS
+from preprocessing.shard_stats import flat_paths, read_shard_stats, read_unigram_counts, print_report, stats_path, unigrams_path
+from preprocessing.manifest import file_checksum, is_stage_done, manifest_path, read_json, write_json_atomic
+
+# preprocessing/segmentation.py imports its siblings directly, like the preprocessing scripts do
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocessing"))
+from segmentation import PRETOKENIZATION_FLAGS
 
 
 def parse_args():
@@ -15,140 +32,712 @@ def parse_args():
     parser.add_argument('--language', type=str, required=True, default="nn")
     parser.add_argument('--input_dir', type=str, required=True, default="/scratch/project_465000498/one/cleaned/nn")
     parser.add_argument('--output_dir', type=str, required=True, default="/scratch/project_465000498/processed_data/nn")
-    parser.add_argument('--shard_size_mb', type=int, required=False, default=512)
+    parser.add_argument('--shard_size_mb', type=int, required=False, default=2048, help='Target size of the uncompressed text of every shard (text compresses roughly 4x with zstd)')
     parser.add_argument('--sample_power', type=float, required=False, default=0.0)
-    return parser.parse_args()
+    parser.add_argument('--n_validation_documents', type=int, required=False, default=10_000)
+    parser.add_argument('--report', action='store_true', help='Only print statistics about already tokenized shards (read from their .stats.json sidecars) and exit')
+    parser.add_argument('--executor', type=str, default="slurm", choices=["slurm", "local"], help='Submit the jobs to SLURM or run them on this machine')
+    parser.add_argument('--local_cores', type=int, default=os.cpu_count(), help='Number of cores used by the local executor')
+    parser.add_argument('--local_gpus', type=int, default=1, help='Number of GPUs used by the local executor (for the BERT training)')
+    parser.add_argument('--skip_training', action='store_true', help='Only preprocess the data, do not schedule the BERT training')
+    parser.add_argument('--train_args', type=str, default="", help='Additional arguments for encoder-only/train.py')
+    parser.add_argument('--remove_text_shards', action='store_true', help='Remove every text shard once its tokenization is recorded, a rerun recreates only the text shards that have to be tokenized again')
+    parser.add_argument('--retrain', action='store_true', help='Train BERT even if a finished training with the same data and arguments is recorded')
+    parser.add_argument('--pack', action='store_true', help='Bin-pack the preprocessing of all languages (comma-separated in --language) into shared SLURM allocations')
+    parser.add_argument('--pack_cores', type=int, default=128, help='Number of cores of every packed allocation')
+    parser.add_argument('--pack_hours', type=int, default=24, help='Time limit of every packed allocation')
+    parser.add_argument('--pack_dir', type=str, default=f"logs/packs/{time.strftime('%Y%m%d-%H%M%S')}", help='Where to store the job graphs, logs and status files of the packed allocations')
+    parser.add_argument('--tokenizer_data_mb', type=float, default=8192, help='The tokenizer waits only for the first shard jobs with at least this much text (it samples 2048 MB by default)')
+    parser.add_argument('--train_gpus', type=int, default=128, help='Number of GPUs of encoder-only/train.sh, the training starts when one shard for each of them is tokenized')
+    parser.add_argument('--tokenize_batch_size', type=int, default=64, help='Number of shards tokenized by one srun job (one rank per shard)')
+    parser.add_argument('--plan', action='store_true', help='Only predict the wall time and core-hours of every stage, recommend shard counts, tokenization batch sizes and node counts, and exit')
+    parser.add_argument('--target_tokens', type=float, default=None, help='With --plan, the number of subwords the model should see during training (instead of --max_steps from --train_args)')
+    parser.add_argument('--max_concurrent_jobs', type=int, default=16, help='With --plan, the number of jobs expected to run at the same time')
+    parser.add_argument('--max_nodes', type=int, default=64, help='With --plan, the largest number of GPU nodes considered for the training')
+    parser.add_argument('--calibration_records', type=str, default=None, help='Glob of stage records from earlier runs that calibrate the cost model, by default the manifests of all languages next to --output_dir')
+    args = parser.parse_args()
+
+    # the jobs run in different working directories
+    args.input_dir = os.path.abspath(args.input_dir)
+    args.output_dir = os.path.abspath(args.output_dir)
+
+    return args
+
+
+def is_input_file(filename):
+    # compressed HPLT files, or plain jsonl files (e.g. data/test)
+    return filename.endswith(".jsonl.zst") or filename.endswith(".jsonl")
+
+
+# zstd frame format: https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md
+ZSTD_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+
+def zstd_content_size(path):
+    # sums the content sizes stored in the headers of all frames, skipping over the blocks of every frame;
+    # returns None if some frame doesn't store its size (e.g. written by a streaming compressor)
+    content_size = 0
+    with open(path, "rb") as f:
+        while True:
+            magic = f.read(4)
+            if len(magic) == 0:
+                return content_size
+            if len(magic) < 4:
+                return None
+            magic = int.from_bytes(magic, "little")
+
+            if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+                f.seek(int.from_bytes(f.read(4), "little"), os.SEEK_CUR)
+                continue
+            if magic != ZSTD_MAGIC:
+                return None
+
+            descriptor = f.read(1)[0]
+            content_size_flag, single_segment, has_checksum, dictionary_flag = descriptor >> 6, (descriptor >> 5) & 1, (descriptor >> 2) & 1, descriptor & 3
+            content_size_bytes = [single_segment, 2, 4, 8][content_size_flag]
+            if content_size_bytes == 0:
+                return None
+
+            # skip the window descriptor and the dictionary id
+            f.seek((1 - single_segment) + [0, 1, 2, 4][dictionary_flag], os.SEEK_CUR)
+            frame_content_size = int.from_bytes(f.read(content_size_bytes), "little")
+            content_size += frame_content_size + (256 if content_size_bytes == 2 else 0)
+
+            # skip the blocks, RLE blocks store a single byte
+            is_last_block = False
+            while not is_last_block:
+                block_header = f.read(3)
+                if len(block_header) < 3:
+                    return None
+                block_header = int.from_bytes(block_header, "little")
+                is_last_block, block_type, block_size = block_header & 1, (block_header >> 1) & 3, block_header >> 3
+                f.seek(1 if block_type == 1 else block_size, os.SEEK_CUR)
+
+            if has_checksum:
+                f.seek(4, os.SEEK_CUR)
+
+
+def sampled_content_size(path, sample_size=16 * 1024 * 1024):
+    # decompresses the beginning of the file and extrapolates its compression ratio to the whole file
+    import zstandard as zstd
+
+    file_size = os.path.getsize(path)
+    n_decompressed = 0
+    with open(path, "rb") as f:
+        reader = zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        while f.tell() < sample_size:
+            chunk = reader.read(1024 * 1024)
+            if len(chunk) == 0:
+                return n_decompressed
+            n_decompressed += len(chunk)
+        return n_decompressed / f.tell() * file_size
+
+
+def uncompressed_size(path):
+    if not path.endswith(".zst"):
+        return os.path.getsize(path)
+
+    content_size = zstd_content_size(path)
+    if content_size is None:
+        content_size = sampled_content_size(path)
+    return content_size
+
+
+def input_file_sizes(input_dir):
+    # uncompressed size of every input file, in MB
+    return {
+        filename: uncompressed_size(os.path.join(input_dir, filename)) / 1024 / 1024
+        for filename in sorted(os.listdir(input_dir))
+        if is_input_file(filename)
+    }
 
 
 def count_total_size(input_dir):
-    total_size = 0
-    for filename in os.listdir(input_dir):
-        if not filename.endswith(".jsonl.zst"):
-            continue
-
-        total_size += os.path.getsize(os.path.join(input_dir, filename))
-
-    total_size /= 1024 * 1024
-    return total_size
+    return sum(input_file_sizes(input_dir).values())
 
 
-def schedule(language, input_dir, output_dir, shard_size):
-    total_size = count_total_size(input_dir)
-    number_of_shards = 2 ** max(0, math.floor(math.log(total_size / (shard_size / 2), 2)))
-    actual_shard_size = total_size / number_of_shards
-
-    print(f"Total size: {total_size:.2f} MB")
-    print(f"Number of shards: {number_of_shards} files, each of roughly {actual_shard_size:.2f} MB", flush=True)
-
-    # recursively remove the output directory
-    shutil.rmtree(output_dir, ignore_errors=True)
+def count_shards(total_size, shard_size):
+    return 2 ** max(0, math.floor(math.log(total_size / (shard_size / 2), 2)))
 
-    # make sure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-    shard_dir = os.path.join(output_dir, "text_shards")
-    os.makedirs(shard_dir, exist_ok=True)
 
-    # schedule shard workers
+def plan_shard_jobs(file_sizes, number_of_shards):
+    # groups the input files into shard jobs of at least 32 shards worth of text, returns (filenames, size, shards) of every job
+    actual_shard_size = sum(file_sizes.values()) / number_of_shards
     num_scheduled_shards = 0.0
     current_input_files, current_input_file_size = [], 0
-    has_scheduled_validation = False
-    shard_job_ids = []
+    shard_jobs = []
 
-    filenames = [filename for filename in os.listdir(input_dir) if filename.endswith(".jsonl.zst")]
-    for i, filename in enumerate(sorted(filenames)):
+    filenames = list(file_sizes.keys())
+    for i, filename in enumerate(filenames):
         current_input_files.append(filename)
-        current_input_file_size += os.path.getsize(os.path.join(input_dir, filename)) / 1024 / 1024
+        current_input_file_size += file_sizes[filename]
 
         if current_input_file_size < 32 * actual_shard_size and i != len(filenames) - 1:
             continue
 
         num_shards = current_input_file_size / actual_shard_size
         shards = list(range(int(num_scheduled_shards), int(num_scheduled_shards + num_shards)))
-        num_scheduled_shards += num_shards
 
         # if we are at the last file, make sure all shards are created
-        if i == len(filenames) - 1 and shards[-1] < number_of_shards - 1:
-            shards += list(range(shards[-1], number_of_shards))
+        if i == len(filenames) - 1:
+            shards = list(range(int(num_scheduled_shards), number_of_shards))
+        num_scheduled_shards += num_shards
+
+        shard_jobs.append((current_input_files, current_input_file_size, shards))
+        current_input_files, current_input_file_size = [], 0
+
+    return shard_jobs
+
+
+def pretokenization_args(language):
+    return [PRETOKENIZATION_FLAGS[language]] if language in PRETOKENIZATION_FLAGS else []
+
+
+def shard_job(language, input_files, shard_dir, shards, sample_power, n_validation_documents, create_validation):
+    extra_args = ["--n_validation_documents", n_validation_documents]
+    if create_validation:
+        extra_args.append("--create_validation")
+
+    return Job(
+        name=f"{language}-SHARD",
+        chdir="preprocessing",
+        slurm_script="preprocessing/shard_worker.sh",
+        slurm_args=[','.join(input_files), shard_dir, ','.join(map(str, shards)), sample_power] + extra_args,
+        python_args=["shard_worker.py", "--input_files", ','.join(input_files), "--output_dir", shard_dir, "--shards", ','.join(map(str, shards)), "--sample_power", sample_power] + extra_args,
+        cpus_per_task=1,
+        log_name=f"{language}-shard"
+    )
+
+
+def tokenizer_job(language, shard_dir, output_dir, n_shards, dependencies):
+    additional_args = pretokenization_args(language)
+    if n_shards is not None:
+        additional_args = ["--n_shards", n_shards] + additional_args
+    return Job(
+        name=f"{language}-TRAIN-TOKENIZER",
+        chdir="preprocessing",
+        slurm_script="preprocessing/train_tokenizer.sh",
+        slurm_args=[shard_dir, output_dir] + additional_args,
+        python_args=["train_tokenizer.py", "--input_dir", shard_dir, "--output_dir", output_dir, "--do_calculate_stats"] + additional_args,
+        dependencies=dependencies,
+        cpus_per_task=7,
+        log_name=f"{language}-train-tokenizer"
+    )
+
+
+def tokenize_job(language, input_shard_files, output_shard_files, tokenizer_path, dependencies, remove_input=False):
+    additional_args = pretokenization_args(language) + (["--remove_input"] if remove_input else [])
+    return Job(
+        name=f"{language}-TOKENIZE",
+        chdir="preprocessing",
+        slurm_script="preprocessing/tokenize_shards.sh",
+        slurm_args=[','.join(input_shard_files), ','.join(output_shard_files), tokenizer_path] + additional_args,
+        python_args=["tokenize_shards.py", f"--input_files={','.join(input_shard_files)}", f"--output_files={','.join(output_shard_files)}", f"--tokenizer_path={tokenizer_path}"] + additional_args,
+        dependencies=dependencies,
+        n_tasks=len(input_shard_files),
+        sbatch_args=[f"--ntasks-per-node={len(input_shard_files)}"],
+        log_name=f"{language}-tokenize"
+    )
+
+
+def training_job(language, output_dir, train_args, n_gpus, dependencies):
+    return Job(
+        name=f"{language}-BERT",
+        chdir="encoder-only",
+        slurm_script="encoder-only/train.sh",
+        slurm_args=[language] + train_args,
+        python_args=["train.py", "--language", language, "--input_dir", output_dir, "--config_file", "configs/base.json", "--output_dir", os.path.join(output_dir, "models")] + train_args,
+        dependencies=dependencies,
+        n_tasks=n_gpus,
+        cpus_per_task=7,
+        n_gpus=n_gpus,
+        log_name=f"{language}-bert"
+    )
+
+
+def fingerprint(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def file_fingerprint(path):
+    # checksumming terabytes of raw input on every rerun would take too long, sizes and modification times are enough
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, int(stat.st_mtime)]
+
+
+def add_stage_record(job, stage_record, stage_key):
+    stage_args = ["--stage_record", stage_record, "--stage_key", stage_key]
+    job.slurm_args += stage_args
+    job.python_args += stage_args
+
+
+def shard_index(filename):
+    # train_00042.jsonl.gz -> 42
+    return int(filename[len("train_"):len("train_") + 5])
+
 
-        print(f"Scheduling [{', '.join(current_input_files)}] to shards [{', '.join(map(str, shards))}]", flush=True)
+def text_shard_path(shard_dir, shard):
+    return os.path.join(shard_dir, "validation.jsonl.gz" if shard == "validation" else f"train_{shard:05d}.jsonl.gz")
+
+
+def is_removed_after_tokenization(text_file, tokenized_shard_dir, recorded_sha256):
+    # a text shard removed by tokenize_shards.py --remove_input, after a tokenization of exactly this text was recorded
+    tokenized_manifest = read_json(manifest_path(os.path.join(tokenized_shard_dir, os.path.basename(text_file))))
+    return not os.path.exists(text_file) and tokenized_manifest is not None and tokenized_manifest["input_sha256"] == recorded_sha256
+
+
+def is_shard_stage_done(stage_record, key, tokenized_shard_dir):
+    # like is_stage_done, but the text shards removed after their tokenization still count as outputs
+    record = read_json(stage_record)
+    if record is None or record["key"] != key:
+        return False
+    return all(
+        (os.path.exists(output_file) and os.path.getsize(output_file) == output["size"])
+        or is_removed_after_tokenization(output_file, tokenized_shard_dir, output["sha256"])
+        for output_file, output in record["outputs"].items()
+    )
+
+
+def remove_stale_shards(output_dir, number_of_shards):
+    # shards left over from a previous run with more shards would be picked up by the tokenizer and by the training
+    shard_dir = os.path.join(output_dir, "text_shards")
+    directories = [shard_dir, os.path.join(output_dir, "tokenized_shards")]
+    directories += [os.path.join(shard_dir, filename) for filename in os.listdir(shard_dir) if filename.startswith("segmented_")]
+
+    for directory in directories:
+        for filename in os.listdir(directory):
+            if filename.startswith("train_") and shard_index(filename) >= number_of_shards:
+                print(f"Removing stale {os.path.join(directory, filename)}", flush=True)
+                os.remove(os.path.join(directory, filename))
+
+
+def schedule(language, input_dir, output_dir, shard_size, executor):
+    # submits only the stages whose record in output_dir/manifest is missing, has a different key or lost some outputs;
+    # returns the tokenization jobs the training has to wait for and the key of the tokenized data
+    file_sizes = input_file_sizes(input_dir)
+
+    # plan from the uncompressed sizes, the compression ratio differs a lot between languages
+    total_size = sum(file_sizes.values())
+    compressed_size = sum(os.path.getsize(os.path.join(input_dir, filename)) for filename in file_sizes) / 1024 / 1024
+    number_of_shards = count_shards(total_size, shard_size)
+    actual_shard_size = total_size / number_of_shards
+
+    print(f"Total size: {total_size:.2f} MB uncompressed, {compressed_size:.2f} MB compressed (ratio {total_size / max(compressed_size, 1e-6):.2f})")
+    print(f"Number of shards: {number_of_shards} files, each of roughly {actual_shard_size:.2f} MB", flush=True)
+
+    # make sure the output directories exist
+    shard_dir = os.path.join(output_dir, "text_shards")
+    tokenized_shard_dir = os.path.join(output_dir, "tokenized_shards")
+    manifest_dir = os.path.join(output_dir, "manifest")
+    for directory in [shard_dir, tokenized_shard_dir, manifest_dir]:
+        os.makedirs(directory, exist_ok=True)
+
+    remove_stale_shards(output_dir, number_of_shards)
+    stage_records = []
+
+    # plan the shard workers, they are submitted after the stages that need their text shards are known
+    has_scheduled_validation = False
+    shard_job_keys, shard_job_plans = [], []
+    shard_keys, shard_jobs_by_shard = {}, {}
+
+    predicted_shard_sizes = []
+
+    for current_input_files, current_input_file_size, shards in plan_shard_jobs(file_sizes, number_of_shards):
+        # the documents are distributed round-robin over the shards of this job
+        predicted_shard_size = current_input_file_size / max(1, len(shards))
+        predicted_shard_sizes += [predicted_shard_size] * len(shards)
 
-        # schedule shards with sbatch
         current_input_files = [os.path.join(input_dir, filename) for filename in current_input_files]
-        command = f"sbatch --job-name {language}-SHARD --chdir preprocessing --output logs/{language}-shard-%j.out preprocessing/shard_worker.sh {','.join(current_input_files)} {shard_dir} {','.join(map(str, shards))} {args.sample_power} {'--create_validation' if not has_scheduled_validation else ''}"
-        bash_output = subprocess.check_output(command, shell=True)
-        print(bash_output.decode("utf-8"))
+        create_validation = not has_scheduled_validation
+        key = fingerprint({
+            "input_files": [file_fingerprint(path) for path in current_input_files],
+            "shards": shards,
+            "sample_power": args.sample_power,
+            "n_validation_documents": args.n_validation_documents,
+            "create_validation": create_validation,
+        })
+        stage_record = os.path.join(manifest_dir, f"shard_{len(shard_job_keys):03d}.json")
+        stage_records.append(stage_record)
+        shard_job_keys.append(key)
+        for shard in shards:
+            shard_keys[shard] = key
+        if create_validation:
+            shard_keys["validation"] = key
         has_scheduled_validation = True
 
-        job_id = bash_output.decode("utf-8").split()[-1]
-        shard_job_ids.append(job_id)
+        shard_job_plans.append({
+            "input_files": current_input_files,
+            "size": current_input_file_size,
+            "predicted_shard_size": predicted_shard_size,
+            "shards": shards + (["validation"] if create_validation else []),
+            "key": key,
+            "stage_record": stage_record,
+            "create_validation": create_validation,
+            "is_done": is_shard_stage_done(stage_record, key, tokenized_shard_dir),
+        })
+
+    if len(predicted_shard_sizes) > 0:
+        print(f"Predicted shard sizes: {min(predicted_shard_sizes):.2f} to {max(predicted_shard_sizes):.2f} MB, at most {max(abs(size / actual_shard_size - 1) for size in predicted_shard_sizes) * 100:.1f}% from the mean", flush=True)
+
+    # schedule tokenizer training, it only waits for the first shard jobs with at least --tokenizer_data_mb of text,
+    # then the tokenization of every shard can start as soon as its shard job finishes
+    n_tokenizer_jobs, tokenizer_data_size = 0, 0.0
+    while n_tokenizer_jobs < len(shard_job_plans) and tokenizer_data_size < args.tokenizer_data_mb:
+        tokenizer_data_size += shard_job_plans[n_tokenizer_jobs]["size"]
+        n_tokenizer_jobs += 1
+    n_tokenizer_shards = max(shard for shard_plan in shard_job_plans[:n_tokenizer_jobs] for shard in shard_plan["shards"] if shard != "validation") + 1
+    if n_tokenizer_jobs == len(shard_job_plans):
+        n_tokenizer_shards = None
+
+    tokenizer_key = fingerprint({"shards": shard_job_keys[:n_tokenizer_jobs], "n_shards": n_tokenizer_shards, "pretokenization": pretokenization_args(language)})
+    stage_record = os.path.join(manifest_dir, "tokenizer.json")
+    stage_records.append(stage_record)
+    tokenizer_record = stage_record
+    is_tokenizer_done = is_stage_done(tokenizer_record, tokenizer_key)
+
+    # the tokenization of the shards that are not up to date
+    pending_shards, tokenization_keys = [], {}
+    for shard in ["validation"] + list(range(number_of_shards)):
+        name = "validation" if shard == "validation" else f"{shard:05d}"
+        key = fingerprint({"shard": shard_keys[shard], "tokenizer": tokenizer_key})
+        stage_record = os.path.join(manifest_dir, f"tokenize_{name}.json")
+        stage_records.append(stage_record)
+        tokenization_keys[name] = key
+
+        if not is_stage_done(stage_record, key):
+            pending_shards.append((shard, name, key, stage_record))
+
+    # the text shards still needed by the tokenizer training and the pending tokenization, the shard workers
+    # recreate them if they were removed after an earlier tokenization
+    needed_shards = {shard for shard, _, _, _ in pending_shards}
+    if not is_tokenizer_done:
+        needed_shards |= {shard for shard_plan in shard_job_plans[:n_tokenizer_jobs] for shard in shard_plan["shards"]} | {"validation"}
 
-        current_input_files, current_input_file_size = [], 0
+    # schedule shard workers
+    for shard_plan in shard_job_plans:
+        is_missing_needed_text = any(shard in needed_shards and not os.path.exists(text_shard_path(shard_dir, shard)) for shard in shard_plan["shards"])
+        if shard_plan["is_done"] and not is_missing_needed_text:
+            print(f"Shards [{', '.join(map(str, shard_plan['shards']))}] are up to date, skipping", flush=True)
+            shard_plan["job"] = None
+            continue
 
+        if shard_plan["is_done"]:
+            print(f"Recreating the removed text shards [{', '.join(map(str, shard_plan['shards']))}], they have to be tokenized again", flush=True)
+        print(f"Scheduling [{', '.join(map(os.path.basename, shard_plan['input_files']))}] to shards [{', '.join(map(str, shard_plan['shards']))}]", flush=True)
+        print(f"Predicted shard size: {shard_plan['predicted_shard_size']:.2f} MB ({(shard_plan['predicted_shard_size'] / actual_shard_size - 1) * 100:+.1f}% from {actual_shard_size:.2f} MB)", flush=True)
+
+        job = shard_job(language, shard_plan["input_files"], shard_dir, [shard for shard in shard_plan["shards"] if shard != "validation"], args.sample_power, args.n_validation_documents, shard_plan["create_validation"])
+        add_stage_record(job, shard_plan["stage_record"], shard_plan["key"])
+        job.cost = SHARD_CORES * cost_model.shard_seconds(shard_plan["size"]) / 3600
+        executor.submit(job)
+        shard_plan["job"] = job
+        for shard in shard_plan["shards"]:
+            shard_jobs_by_shard[shard] = job
 
     # schedule tokenizer training
-    print(f"Scheduling tokenizer training", flush=True)
-
-    additional_args = ""
-    if args.language == "ja":
-        additional_args = "--do_japanese_pretokenization"
-    elif args.language == "ko":
-        additional_args = "--do_korean_pretokenization"
-    elif args.language == "my":
-        additional_args = "--do_burmese_pretokenization"
-    elif args.language == "th":
-        additional_args = "--do_thai_pretokenization"
-    elif args.language == "zh":
-        additional_args = "--do_chinese_pretokenization"
-
-    command = f"sbatch --job-name {language}-TRAIN-TOKENIZER --chdir preprocessing --output logs/{language}-train-tokenizer-%j.out --dependency=afterok:{':'.join(shard_job_ids)} preprocessing/train_tokenizer.sh {shard_dir} {output_dir} {additional_args}"
-    bash_output = subprocess.check_output(command, shell=True)
-    print(bash_output.decode("utf-8"))
-    tokenizer_job_id = bash_output.decode("utf-8").split()[-1]
-
-    # schedule shard tokenization, batch together 64 jobs
-    tokenized_shard_dir = os.path.join(output_dir, "tokenized_shards")
-    os.makedirs(tokenized_shard_dir, exist_ok=True)
+    tokenizer_jobs = []
+    if is_tokenizer_done:
+        print(f"Tokenizer is up to date, skipping", flush=True)
+    else:
+        print(f"Scheduling tokenizer training on {'all shards' if n_tokenizer_shards is None else f'the first {n_tokenizer_shards} shards'} ({tokenizer_data_size:.2f} MB)", flush=True)
+        dependencies = [shard_plan["job"] for shard_plan in shard_job_plans[:n_tokenizer_jobs] if shard_plan["job"] is not None]
+        job = tokenizer_job(language, shard_dir, output_dir, n_tokenizer_shards, dependencies)
+        add_stage_record(job, tokenizer_record, tokenizer_key)
+        job.cost = TOKENIZER_CORES * cost_model.tokenizer_seconds / 3600
+        executor.submit(job)
+        tokenizer_jobs.append(job)
+
+    # schedule tokenization of the shards that are not up to date (and the validation set), batch together --tokenize_batch_size of them;
+    # the validation set and the shards of the first epoch go first
+    tokenizer_path = os.path.join(output_dir, "tokenizer.json")
+    print(f"{number_of_shards + 1 - len(pending_shards)} of {number_of_shards + 1} tokenized shards are up to date", flush=True)
+
+    # a queued shard isn't ready until it's tokenized again, the sidecars of an earlier tokenization (possibly with
+    # another tokenizer or shard plan) would make the training read the stale shard
+    for _, name, _, _ in pending_shards:
+        output_file = os.path.join(tokenized_shard_dir, f"{'validation' if name == 'validation' else f'train_{name}'}.pt.gz")
+        for path in [manifest_path(output_file), stats_path(output_file), unigrams_path(output_file), *flat_paths(output_file)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # the expected number of shards, train.py waits for the missing ones instead of training without them, and accepts
+    # only shards tokenized with this tokenizer; a retrained tokenizer records its checksum here when it's saved
+    tokenizer_checksum = file_checksum(tokenizer_path) if is_tokenizer_done else None
+    write_json_atomic(os.path.join(tokenized_shard_dir, "shards.json"), {"n_shards": number_of_shards, "tokenizer_sha256": tokenizer_checksum})
+
+    first_epoch_jobs = []
+    n_first_epoch_shards = args.local_gpus if args.executor == "local" else args.train_gpus
+    batch_size = args.tokenize_batch_size
+    for shard_batch in range(math.ceil(len(pending_shards) / batch_size)):
+        batch = pending_shards[shard_batch * batch_size:(shard_batch + 1) * batch_size]
+        print(f"Scheduling tokenization of shards, batch {shard_batch}, shards {', '.join(name for _, name, _, _ in batch)}", flush=True)
+
+        input_shard_files = [text_shard_path(shard_dir, shard) for shard, _, _, _ in batch]
+        output_shard_files = [os.path.join(tokenized_shard_dir, f"{'validation' if name == 'validation' else f'train_{name}'}.pt.gz") for _, name, _, _ in batch]
+
+        # the shard jobs are dependencies only if they were resubmitted
+        dependencies = list(tokenizer_jobs)
+        for shard, _, _, _ in batch:
+            if shard in shard_jobs_by_shard and shard_jobs_by_shard[shard] not in dependencies:
+                dependencies.append(shard_jobs_by_shard[shard])
+
+        job = tokenize_job(language, input_shard_files, output_shard_files, tokenizer_path, dependencies, args.remove_text_shards)
+        add_stage_record(job, ','.join(stage_record for _, _, _, stage_record in batch), ','.join(key for _, _, key, _ in batch))
+        job.cost = TOKENIZE_CORES_PER_RANK * len(input_shard_files) * cost_model.tokenize_seconds(actual_shard_size) / 3600
+        executor.submit(job)
+        if any(shard == "validation" or shard < n_first_epoch_shards for shard, _, _, _ in batch):
+            first_epoch_jobs.append(job)
+
+    # records of stages that are not part of this plan anymore
+    for filename in os.listdir(manifest_dir):
+        if filename.endswith(".json") and filename != "train.json" and os.path.join(manifest_dir, filename) not in stage_records:
+            os.remove(os.path.join(manifest_dir, filename))
+
+    # the training can start when the validation set and one shard for every GPU are tokenized
+    return first_epoch_jobs, fingerprint(tokenization_keys)
+
+
+def schedule_training(language, output_dir, executor, dependencies, data_key):
+    key = fingerprint({"data": data_key, "train_args": args.train_args})
+    stage_record = os.path.join(output_dir, "manifest", "train.json")
+    if not args.retrain and is_stage_done(stage_record, key):
+        print(f"BERT training is up to date, skipping (use --retrain to train again)", flush=True)
+        return
 
-    tokenization_job_ids = []
-    for shard_batch in range(math.ceil(number_of_shards / 64)):
-        print(f"Scheduling tokenization of shards, batch {shard_batch}, shards {shard_batch * 64} to {min(number_of_shards - 1, (shard_batch + 1) * 64 - 1)}", flush=True)
+    print(f"Scheduling BERT training", flush=True)
+    n_gpus = args.local_gpus if args.executor == "local" else 0
+    job = training_job(language, output_dir, args.train_args.split(), n_gpus, dependencies)
+    add_stage_record(job, stage_record, key)
+    executor.submit(job)
+
+
+def parse_train_args(train_args):
+    # the few arguments of encoder-only/train.py needed by the cost model, with the same defaults
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--config_file", type=str, default="configs/base.json")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--max_steps", type=int, default=31250)
+    parser.add_argument("--seq_length", type=int, default=128)
+    return parser.parse_known_args(train_args.split())[0]
+
+
+def recommend_tokenize_batch_size(number_of_shards, shard_size):
+    # as many ranks as fit into one node (by cores and by the peak memory of every rank), balanced over the batches
+    n_batches = math.ceil((number_of_shards + 1) / cost_model.tokenize_ranks_per_node(shard_size))
+    return math.ceil((number_of_shards + 1) / n_batches)
+
+
+def predict_preprocessing(file_sizes, number_of_shards, tokenize_batch_size):
+    # returns {stage: (wall time in seconds, core-hours)}, at most --max_concurrent_jobs jobs run at the same time
+    shard_size = sum(file_sizes.values()) / number_of_shards
+    shard_times = [cost_model.shard_seconds(size) for _, size, _ in plan_shard_jobs(file_sizes, number_of_shards)]
+    tokenize_time = cost_model.tokenize_seconds(shard_size)
+    n_batches = math.ceil((number_of_shards + 1) / tokenize_batch_size)
+
+    return {
+        "shard": (
+            max(max(shard_times), sum(shard_times) / args.max_concurrent_jobs) + JOB_STARTUP_SECONDS,
+            SHARD_CORES * sum(shard_times) / 3600
+        ),
+        "tokenizer": (
+            cost_model.tokenizer_seconds + JOB_STARTUP_SECONDS,
+            TOKENIZER_CORES * cost_model.tokenizer_seconds / 3600
+        ),
+        "tokenize": (
+            math.ceil(n_batches / args.max_concurrent_jobs) * (tokenize_time + JOB_STARTUP_SECONDS),
+            TOKENIZE_CORES_PER_RANK * (number_of_shards + 1) * tokenize_time / 3600
+        ),
+    }
+
+
+def predict_training(n_nodes, train_args, n_subwords):
+    # returns (wall time in seconds or None without calibration, number of steps, subwords seen by the model)
+    n_gpus = n_nodes * GPUS_PER_NODE
+    subwords_per_step = n_gpus * train_args.batch_size * train_args.seq_length
+    n_steps = math.ceil(args.target_tokens / subwords_per_step) if args.target_tokens is not None else train_args.max_steps
+    steps_per_second = cost_model.train_steps_per_second(os.path.basename(train_args.config_file), n_gpus)
+    wall_time = n_steps / steps_per_second + JOB_STARTUP_SECONDS if steps_per_second is not None else None
+    return wall_time, n_steps, n_steps * subwords_per_step
+
+
+def plan(language, input_dir):
+    # dry run, nothing is submitted
+    file_sizes = input_file_sizes(input_dir)
+    total_size = sum(file_sizes.values())
+    n_subwords = cost_model.n_subwords(total_size)
+    train_args = parse_train_args(args.train_args)
+
+    print(f"\nPlan for {language}: {total_size:,.0f} MB of uncompressed text in {len(file_sizes)} files, about {n_subwords / 1e9:.2f}B subwords", flush=True)
+
+    # training nodes: with --target_tokens the fastest node count, otherwise the training length is fixed by --max_steps
+    # and more nodes only show more data to the model, so the smallest node count that sees all data at least once
+    node_counts = [2 ** i for i in range(int(math.log2(args.max_nodes)) + 1)]
+    trainings = {n_nodes: predict_training(n_nodes, train_args, n_subwords) for n_nodes in node_counts}
+    if args.target_tokens is not None:
+        calibrated = [n_nodes for n_nodes in node_counts if trainings[n_nodes][0] is not None]
+        recommended_nodes = min(calibrated, key=lambda n_nodes: (trainings[n_nodes][0], n_nodes)) if len(calibrated) > 0 else node_counts[-1]
+    else:
+        recommended_nodes = next((n_nodes for n_nodes in node_counts if trainings[n_nodes][2] >= n_subwords), node_counts[-1])
+    recommended_gpus = recommended_nodes * GPUS_PER_NODE
+
+    # shard counts: every training rank should get its own shard, and tokenizing fewer larger shards
+    # has to be balanced against the limited number of concurrently running jobs
+    min_shards = recommended_gpus if total_size / recommended_gpus >= 1.0 else 1
+    candidates = []
+    for number_of_shards in [2 ** i for i in range(13)]:
+        shard_size = total_size / number_of_shards
+        if number_of_shards < min_shards or (shard_size < 1.0 and number_of_shards > 1):
+            continue
+        batch_size = recommend_tokenize_batch_size(number_of_shards, shard_size)
+        stages = predict_preprocessing(file_sizes, number_of_shards, batch_size)
+        candidates.append((sum(wall_time for wall_time, _ in stages.values()), number_of_shards, batch_size, stages))
+    _, recommended_shards, recommended_batch_size, recommended_stages = min(candidates, key=lambda candidate: candidate[:2])
+
+    current_shards = count_shards(total_size, args.shard_size_mb)
+    current_stages = predict_preprocessing(file_sizes, current_shards, args.tokenize_batch_size)
+
+    print(f"\n{'number of shards':>16} | {'shard size':>12} | {'batch size':>10} | {'preprocessing':>13}")
+    for wall_time, number_of_shards, batch_size, _ in sorted(candidates, key=lambda candidate: candidate[1]):
+        marker = " <- recommended" if number_of_shards == recommended_shards else (" <- current" if number_of_shards == current_shards else "")
+        print(f"{number_of_shards:>16} | {total_size / number_of_shards:>9,.0f} MB | {batch_size:>10} | {wall_time / 3600:>11.2f} h{marker}")
+
+    training_wall_time, n_steps, n_seen_subwords = trainings[recommended_nodes]
+    print(f"\n{'nodes':>5} | {'steps':>8} | {'subwords seen':>13} | {'wall time':>9} | {'GPU-hours':>9}")
+    for n_nodes in node_counts:
+        wall_time, steps, seen_subwords = trainings[n_nodes]
+        wall_time_text = f"{wall_time / 3600:>7.2f} h" if wall_time is not None else f"{'?':>9}"
+        gpu_hours_text = f"{wall_time / 3600 * n_nodes * GPUS_PER_NODE:>9,.0f}" if wall_time is not None else f"{'?':>9}"
+        print(f"{n_nodes:>5} | {steps:>8,} | {seen_subwords / 1e9:>12.1f}B | {wall_time_text} | {gpu_hours_text}" + (" <- recommended" if n_nodes == recommended_nodes else ""))
+
+    for name, stages, number_of_shards, batch_size in [
+        ("current", current_stages, current_shards, args.tokenize_batch_size),
+        ("recommended", recommended_stages, recommended_shards, recommended_batch_size),
+    ]:
+        print(f"\n{name}: {number_of_shards} shards, tokenization batches of {batch_size}, {recommended_nodes} training nodes")
+        for stage, (wall_time, core_hours) in stages.items():
+            print(f"    {stage:<10} {wall_time / 3600:>8.2f} h {core_hours:>10,.1f} core-hours")
+        if training_wall_time is not None:
+            print(f"    {'train':<10} {training_wall_time / 3600:>8.2f} h {training_wall_time / 3600 * recommended_gpus:>10,.1f} GPU-hours")
+            print(f"    time to model: {(sum(wall_time for wall_time, _ in stages.values()) + training_wall_time) / 3600:.2f} h")
+        else:
+            print(f"    {'train':<10} no calibration for {os.path.basename(train_args.config_file)} yet")
+
+    print(f"\nRecommended: --shard_size_mb {max(1, math.ceil(1.5 * total_size / recommended_shards))} --tokenize_batch_size {recommended_batch_size}, train on {recommended_nodes} nodes", flush=True)
+
+
+def schedule_packed(languages, shard_size):
+    # first-fit decreasing bin packing of the languages by their estimated preprocessing cost,
+    # every bin is one allocation that runs the job graphs of its languages with the local executor
+    capacity = 0.8 * args.pack_cores * args.pack_hours  # leave some slack for the imprecise estimates
+    costs = {language: cost_model.preprocessing_core_hours(count_total_size(args.input_dir.format(language=language))) for language in languages}
+
+    bins, unpacked_languages = [], []
+    for language in sorted(languages, key=lambda language: costs[language], reverse=True):
+        if costs[language] > capacity:
+            unpacked_languages.append(language)
+            continue
 
-        input_shard_files = []
-        output_shard_files = []
-        for shard in range(64):
-            if shard_batch * 64 + shard >= number_of_shards:
+        for packed_languages in bins:
+            if sum(costs[packed_language] for packed_language in packed_languages) + costs[language] <= capacity:
+                packed_languages.append(language)
                 break
+        else:
+            bins.append([language])
 
-            input_shard_files.append(os.path.join(shard_dir, f"train_{shard_batch * 64 + shard:05d}.jsonl.gz"))
-            output_shard_files.append(os.path.join(tokenized_shard_dir, f"train_{shard_batch * 64 + shard:05d}.pt.gz"))
+    slurm_executor = SlurmExecutor()
+    os.makedirs(args.pack_dir, exist_ok=True)
 
-        input_shard_files = ",".join(input_shard_files)
-        output_shard_files = ",".join(output_shard_files)
-        tokenizer_path = os.path.join(output_dir, "tokenizer.json")
-        command = f"sbatch --job-name {language}-TOKENIZE --chdir preprocessing --output logs/{language}-tokenize-%j.out --dependency=afterok:{tokenizer_job_id} preprocessing/tokenize_shards.sh {input_shard_files} {output_shard_files} {tokenizer_path}"
-        bash_output = subprocess.check_output(command, shell=True).decode("utf-8")
-        print(bash_output)
-        tokenization_job_ids.append(bash_output.split()[-1])
+    for i, packed_languages in enumerate(bins):
+        print(f"Packing [{', '.join(packed_languages)}] into allocation {i}, estimated {sum(costs[language] for language in packed_languages):.1f} core-hours", flush=True)
 
-    # schedule validation tokenization
-    print(f"Scheduling tokenization of the validation set", flush=True)
-
-    input_shard_file = os.path.join(shard_dir, "validation.jsonl.gz")
-    output_shard_file = os.path.join(tokenized_shard_dir, "validation.pt.gz")
-    tokenizer_path = os.path.join(output_dir, "tokenizer.json")
-    command = f"sbatch --job-name {language}-TOKENIZE --chdir preprocessing --output logs/{language}-tokenize-%j.out --dependency=afterok:{tokenizer_job_id} preprocessing/tokenize_shards.sh {input_shard_file} {output_shard_file} {tokenizer_path}"
-    bash_output = subprocess.check_output(command, shell=True).decode("utf-8")
-    print(bash_output)
-    tokenization_job_ids.append(bash_output.split()[-1])
+        pack_executor = LocalExecutor(args.pack_cores, 0, log_dir=os.path.join(args.pack_dir, "logs"))
+        data_keys = {}
+        for language in packed_languages:
+            _, data_keys[language] = schedule(language, args.input_dir.format(language=language), args.output_dir.format(language=language), shard_size, pack_executor)
 
+        if len(pack_executor.jobs) == 0:
+            print(f"Nothing to preprocess in allocation {i}", flush=True)
+            if not args.skip_training:
+                for language in packed_languages:
+                    schedule_training(language, args.output_dir.format(language=language), slurm_executor, [], data_keys[language])
+            continue
 
-    # schedule BERT training
-    print(f"Scheduling BERT training", flush=True)
-    command = f"sbatch --job-name {language}-BERT --chdir encoder-only --output logs/{language}-bert-%j.out --dependency=afterok:{':'.join(tokenization_job_ids)} encoder-only/train.sh {language}"
-    bash_output = subprocess.check_output(command, shell=True)
-    print(bash_output.decode("utf-8"), flush=True)
+        plan_path = os.path.abspath(os.path.join(args.pack_dir, f"pack_{i:03d}.json"))
+        pack_executor.save(plan_path)
+
+        pack_job = Job(
+            name=f"PACK-{i}",
+            chdir=".",
+            slurm_script="pack.sh",
+            slurm_args=[plan_path],
+            python_args=["executors.py", plan_path],
+            sbatch_args=[f"--cpus-per-task={args.pack_cores}", f"--time={args.pack_hours}:00:00"],
+            log_name=f"pack-{i:03d}"
+        )
+        slurm_executor.submit(pack_job)
+        print(f"Logs of every task are in {pack_executor.log_dir}, their status in {plan_path[:-len('.json')]}.status.json", flush=True)
+
+        if not args.skip_training:
+            for language in packed_languages:
+                schedule_training(language, args.output_dir.format(language=language), slurm_executor, [pack_job], data_keys[language])
+
+    # languages too large for one allocation get their own chain of jobs
+    for language in unpacked_languages:
+        print(f"{language} is too large to be packed ({costs[language]:.1f} core-hours), scheduling it separately", flush=True)
+        output_dir = args.output_dir.format(language=language)
+        first_epoch_jobs, data_key = schedule(language, args.input_dir.format(language=language), output_dir, shard_size, slurm_executor)
+        if not args.skip_training:
+            schedule_training(language, output_dir, slurm_executor, first_epoch_jobs, data_key)
+
+
+def report(output_dir):
+    tokenized_shard_dir = os.path.join(output_dir, "tokenized_shards")
+    shard_stats = read_shard_stats(tokenized_shard_dir)
+    if len(shard_stats) == 0:
+        print(f"No shard statistics found in {tokenized_shard_dir}", flush=True)
+        return
+    print_report(shard_stats, read_unigram_counts(tokenized_shard_dir, shard_stats), show_shards=True)
 
 
 if __name__ == "__main__":
     args = parse_args()
-    schedule(args.language, args.input_dir, args.output_dir, args.shard_size_mb)
+
+    languages = args.language.split(",")
+
+    # throughput measured by earlier runs (of all languages next to this one)
+    if args.calibration_records is None:
+        if "{language}" in args.output_dir:
+            args.calibration_records = os.path.join(args.output_dir.format(language="*"), "manifest", "*.json")
+        else:
+            args.calibration_records = os.path.join(os.path.dirname(args.output_dir), "*", "manifest", "*.json")
+    cost_model = CostModel.from_records(args.calibration_records)
+
+    if args.plan:
+        print(f"Cost model calibrated from {args.calibration_records}:\n{cost_model.describe()}", flush=True)
+        for language in languages:
+            plan(language, args.input_dir.format(language=language))
+        exit(0)
+
+    if args.report:
+        for language in languages:
+            report(args.output_dir.format(language=language))
+        exit(0)
+
+    if args.pack:
+        schedule_packed(languages, args.shard_size_mb)
+        exit(0)
+
+    if args.executor == "local":
+        executor = LocalExecutor(args.local_cores, args.local_gpus)
+    else:
+        executor = SlurmExecutor()
+
+    for language in languages:
+        input_dir, output_dir = args.input_dir.format(language=language), args.output_dir.format(language=language)
+        first_epoch_jobs, data_key = schedule(language, input_dir, output_dir, args.shard_size_mb, executor)
+        if not args.skip_training:
+            schedule_training(language, output_dir, executor, first_epoch_jobs, data_key)
+
+    success = executor.run()
+    exit(0 if success else 1)
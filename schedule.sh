@@ -37,8 +37,8 @@ LANGUAGE=${1}
 INPUT_DIR="/scratch/project_465000498/one/cleaned/${LANGUAGE}"
 OUTPUT_DIR="/scratch/project_465000498/processed_data/${LANGUAGE}"
 
-## shard size in MB, default 512
-SHARD_SIZE_MB=${2:-512}
+## uncompressed shard size in MB, default 2048 (about 512 MB of zstd-compressed input)
+SHARD_SIZE_MB=${2:-2048}
 SAMPLE_POWER=${3:-0.0}
 
 # run the script
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the scripts of the repository import their siblings directly, like when they are run from their directories
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(root)
+sys.path.append(os.path.join(root, "preprocessing"))
+sys.path.append(os.path.join(root, "encoder-only"))
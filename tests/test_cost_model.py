@@ -0,0 +1,38 @@
+from cost_model import CostModel, MEMORY_PER_NODE_MB
+
+
+def tokenize_record(size_mb, max_rss_mb):
+    n_bytes = int(size_mb * 1024 * 1024)
+    return {"stage": "tokenize", "seconds": 10.0, "n_documents": 100, "n_subwords": n_bytes // 4, "n_bytes": n_bytes, "max_rss_mb": max_rss_mb}
+
+
+def test_small_shards_only_measure_the_base_memory():
+    # data/test-sized shards: a few hundred KB each, all of the peak memory is the process itself
+    cost_model = CostModel([tokenize_record(0.2, 1500.0), tokenize_record(0.3, 1550.0), tokenize_record(0.25, 1600.0)])
+
+    assert cost_model.tokenize_rss_base_mb == 1550.0
+    assert cost_model.tokenize_rss_mb(2048) < 16 * 1024
+    assert cost_model.tokenize_ranks_per_node(2048) >= 16
+
+
+def test_memory_is_fitted_as_base_plus_slope():
+    records = [tokenize_record(size, 1000.0 + 2.5 * size) for size in [128, 512, 1024, 2048]] + [tokenize_record(0.1, 900.0)]
+    cost_model = CostModel(records)
+
+    assert abs(cost_model.tokenize_rss_base_mb - 1000.0) < 1e-6
+    assert abs(cost_model.tokenize_rss_per_mb - 2.5) < 1e-6
+    assert cost_model.tokenize_ranks_per_node(2048) == int(MEMORY_PER_NODE_MB // (1000.0 + 2.5 * 2048))
+
+
+def test_one_large_size_uses_the_median_over_the_base():
+    records = [tokenize_record(0.1, 1000.0)] + [tokenize_record(1024, rss) for rss in [3000.0, 4000.0, 3500.0]]
+    cost_model = CostModel(records)
+
+    assert cost_model.tokenize_rss_base_mb == 1000.0
+    assert abs(cost_model.tokenize_rss_per_mb - 2500.0 / 1024) < 1e-6
+
+
+def test_defaults_without_records():
+    cost_model = CostModel()
+    assert cost_model.tokenize_ranks_per_node(2048) >= 16
+    assert cost_model.tokenize_ranks_per_node(10 ** 6) == 1
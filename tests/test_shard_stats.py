@@ -0,0 +1,26 @@
+import torch
+
+from shard_stats import compute_stats, compute_unigram_counts, merge_unigram_counts, read_shard_stats, read_unigram_counts, stats_path, unigrams_path, write_stats
+
+
+def test_unigram_counts_are_kept_out_of_the_stats_sidecar(tmp_path):
+    documents = [torch.tensor([5, 6, 6], dtype=torch.int16), torch.tensor([7], dtype=torch.int16)]
+    shard = str(tmp_path / "train_00000.pt.gz")
+    write_stats(stats_path(shard), compute_stats(documents, vocab_size=10))
+    write_stats(unigrams_path(shard), compute_unigram_counts(documents, vocab_size=10))
+
+    shard_stats = read_shard_stats(str(tmp_path))
+    assert list(shard_stats) == ["train_00000"]
+    assert "unigram_counts" not in shard_stats["train_00000"]
+    assert shard_stats["train_00000"]["n_subwords"] == 4
+
+    unigram_counts = read_unigram_counts(str(tmp_path), shard_stats)
+    assert merge_unigram_counts(unigram_counts) == [0, 0, 0, 0, 0, 1, 2, 1, 0, 0]
+
+
+def test_older_sidecars_with_unigram_counts(tmp_path):
+    stats = {**compute_stats([torch.tensor([1, 2], dtype=torch.int16)], vocab_size=3), "unigram_counts": [0, 1, 1]}
+    write_stats(stats_path(str(tmp_path / "train_00001.pt.gz")), stats)
+
+    shard_stats = read_shard_stats(str(tmp_path))
+    assert read_unigram_counts(str(tmp_path), shard_stats) == [[0, 1, 1]]
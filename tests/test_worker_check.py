@@ -0,0 +1,29 @@
+import signal
+
+from worker_check import REPRODUCED, WORKERS_CRASH, NOT_REPRODUCED, run_child, describe_exit, check_outcome
+
+
+def test_describe_exit_of_real_children(tmp_path):
+    script = tmp_path / "child.py"
+    script.write_text("import os, signal, sys\nif sys.argv[1] == 'segfault':\n    os.kill(os.getpid(), signal.SIGSEGV)\nsys.exit(int(sys.argv[1]))\n")
+
+    assert describe_exit(run_child(script, ["0"])) == "ok"
+    assert describe_exit(run_child(script, ["3"])) == "failed (exit code 3)"
+    assert describe_exit(run_child(script, ["segfault"])) == "crashed (SIGSEGV)"
+
+
+def test_the_fork_crash_is_reproduced():
+    status, message = check_outcome(-signal.SIGSEGV, 0, "spawn")
+    assert status == REPRODUCED
+    assert "SIGSEGV" in message
+
+
+def test_a_missing_fork_crash_is_not_a_pass():
+    assert check_outcome(0, 0, "spawn")[0] == NOT_REPRODUCED
+    assert check_outcome(1, 0, "spawn")[0] == NOT_REPRODUCED
+
+
+def test_crashing_workers_of_the_training_start_method_fail():
+    assert check_outcome(-signal.SIGSEGV, -signal.SIGSEGV, "spawn")[0] == WORKERS_CRASH
+    assert check_outcome(0, 1, "forkserver")[0] == WORKERS_CRASH
+    assert len({REPRODUCED, WORKERS_CRASH, NOT_REPRODUCED}) == 3